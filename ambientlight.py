@@ -1,19 +1,31 @@
 import argparse
+import array
+import bisect
 import collections
+import copy
+import errno
+import fcntl
+import functools
+import itertools
+import math
 import re
 
 import os
+import select
 import signal
+import socket
+import struct
 import sys
 import time
 import termios
 import threading
+import traceback
 import tty
 
-import RPi.GPIO
-
 import BaseHTTPServer
+import Queue
 import SimpleHTTPServer
+import StringIO
 import json
 import urlparse
 
@@ -52,6 +64,9 @@ class UnbufferedInput(object):
 
 class Light(object):
 
+    # whether show holds the caller up for as long as the frame takes to go out
+    show_blocks = False
+
 
     def size(self):
 
@@ -68,26 +83,256 @@ class Light(object):
         pass
 
 
+    def set_frame(self, frame):
+
+        # frame is a packed buffer of (R,G,B) bytes, one triple per pixel
+        for pixel_index in xrange(len(frame) // 3):
+            self.set(pixel_index, tuple(frame[pixel_index*3:pixel_index*3+3]))
+
+
     def show(self):
 
         pass
 
 
+    def show_partial(self, pixel_start, pixel_stop):
+
+        # drivers that can update a subrange of pixels override this
+        self.show()
+
+
+    def skip_show(self):
+
+        # in place of show for a step whose frame is unchanged; wrapping lights
+        # pass it on, so that a TimingLight does not take it for a late frame
+        pass
+
+
+    def close(self):
+
+        pass
+
+
 
 class TimingLight(Light):
 
-    def __init__(self, strip_size, write_stream = sys.stdout, write_prefix = '', write_suffix = ''):
+    # wraps another light and records the interval between shows into a ring
+    # buffer; summaries are written from a reporter thread, so the frame loop
+    # only ever stores two numbers
 
-        self.strip_size = strip_size
-        self.strip_colors = [(0,0,0) for pixel_index in xrange(strip_size)]
+    def __init__(self, light, step_rate = 0.0, interval_count = 4096, summary_interval = 5.0, gap_duration = 0.5,
+                 trace_path = 'ambientlight-trace.txt', write_stream = sys.stdout, write_prefix = '', write_suffix = ''):
+
+        self.light = light
+        self.strip_size = light.strip_size
+        self.show_blocks = light.show_blocks
+
+        # longer intervals are idle time between transitions, not frames
+        self.gap_duration = gap_duration
+
+        # a frame is late once it overruns its step by half a step
+        self.deadline_duration = (1.5 / step_rate if step_rate > 0.0 else None)
+
+        self.show_times     = array.array('d', [0.0] * interval_count)
+        self.show_intervals = array.array('d', [0.0] * interval_count)
+        self.interval_index = 0
+        self.last_show_time = None
+
+        self.summary_interval = summary_interval
+        self.summary_interval_index = 0
+        self.missed_deadline_count = 0
+
+        self.trace_path = trace_path
+        self.trace_event = threading.Event()
 
         self.write_stream = write_stream
         self.write_prefix = write_prefix
         self.write_suffix = write_suffix
 
+        self.reporter_thread = None
+        self.reporter_thread_running = False
+
+
+    def size(self):
+
+        return self.light.size()
+
+
+    def pixels(self):
+
+        return self.light.pixels()
+
+
+    def set(self, pixel_index, pixel_color):
+
+        self.light.set(pixel_index, pixel_color)
+
+
+    def set_frame(self, frame):
+
+        self.light.set_frame(frame)
+
+
+    def show(self):
+
+        self.light.show()
+        self.record_show()
+
+
+    def show_partial(self, pixel_start, pixel_stop):
+
+        self.light.show_partial(pixel_start, pixel_stop)
+        self.record_show()
+
+
+    def skip_show(self):
+
+        self.light.skip_show()
+
+        # the interval up to the next show spans the skipped step, so it is
+        # neither a frame nor a missed deadline
         self.last_show_time = None
 
 
+    def close(self):
+
+        self.light.close()
+
+
+    def record_show(self):
+
+        show_time = time.time()
+
+        if self.last_show_time is not None:
+            show_interval = show_time - self.last_show_time
+
+            if show_interval <= self.gap_duration:
+                interval_slot = self.interval_index % len(self.show_intervals)
+                self.show_times[interval_slot] = show_time
+                self.show_intervals[interval_slot] = show_interval
+                self.interval_index += 1
+
+        self.last_show_time = show_time
+
+
+    def start(self):
+
+        if not self.reporter_thread:
+            self.reporter_thread_running = True
+            self.reporter_thread = threading.Thread(target = self.reporter_thread_proc)
+            self.reporter_thread.daemon = True
+            self.reporter_thread.start()
+
+
+    def stop(self):
+
+        if self.reporter_thread:
+            self.reporter_thread_running = False
+            self.trace_event.set()
+
+            self.reporter_thread.join()
+            self.reporter_thread = None
+
+
+    def request_trace(self):
+
+        # safe to call from a signal handler, the reporter thread does the writing
+        self.trace_event.set()
+
+
+    def reporter_thread_proc(self):
+
+        next_summary_time = time.time() + self.summary_interval
+
+        while self.reporter_thread_running:
+            self.trace_event.wait(max(0.0, next_summary_time - time.time()))
+
+            if self.trace_event.is_set():
+                self.trace_event.clear()
+                if self.reporter_thread_running:
+                    self.write_trace()
+
+            if time.time() >= next_summary_time:
+                next_summary_time = time.time() + self.summary_interval
+                self.write_summary()
+
+
+    def recent_intervals(self, interval_index_start):
+
+        # oldest first; whatever has been overwritten since is lost
+        interval_index_stop = self.interval_index
+        interval_index_start = max(interval_index_start, interval_index_stop - len(self.show_intervals))
+
+        interval_slots = [interval_index % len(self.show_intervals) for interval_index in xrange(interval_index_start, interval_index_stop)]
+
+        return interval_index_stop, [(self.show_times[interval_slot], self.show_intervals[interval_slot]) for interval_slot in interval_slots]
+
+
+    def write_summary(self):
+
+        self.summary_interval_index, recent_intervals = self.recent_intervals(self.summary_interval_index)
+
+        if not recent_intervals:
+            return
+
+        show_intervals = sorted(show_interval for show_time, show_interval in recent_intervals)
+        interval_count = len(show_intervals)
+
+        mean_interval = sum(show_intervals) / interval_count
+        jitter = math.sqrt(sum((show_interval - mean_interval) ** 2 for show_interval in show_intervals) / interval_count)
+
+        if self.deadline_duration is not None:
+            missed_deadline_count = sum(1 for show_interval in show_intervals if show_interval > self.deadline_duration)
+            self.missed_deadline_count += missed_deadline_count
+        else:
+            missed_deadline_count = 0
+
+        percentile = lambda fraction: show_intervals[min(interval_count - 1, int(fraction * interval_count))]
+
+        write_stream = self.write_stream
+        write_stream.write(self.write_prefix)
+        write_stream.write('%d frames, %.1f/s: min %.1f mean %.1f p50 %.1f p95 %.1f p99 %.1f max %.1f ms, jitter %.2f ms, missed %d (%d total)' % (
+            interval_count,
+            1.0 / mean_interval,
+            show_intervals[0]  * 1000.0,
+            mean_interval      * 1000.0,
+            percentile(0.50)   * 1000.0,
+            percentile(0.95)   * 1000.0,
+            percentile(0.99)   * 1000.0,
+            show_intervals[-1] * 1000.0,
+            jitter             * 1000.0,
+            missed_deadline_count,
+            self.missed_deadline_count))
+        write_stream.write(self.write_suffix)
+        write_stream.flush()
+
+
+    def write_trace(self):
+
+        interval_index_stop, recent_intervals = self.recent_intervals(0)
+
+        with open(self.trace_path, 'w') as trace_file:
+            trace_file.write('# show_time interval_ms\n')
+            for show_time, show_interval in recent_intervals:
+                trace_file.write('%.6f %.3f\n' % (show_time, show_interval * 1000.0))
+
+        self.write_stream.write('Wrote %d frame intervals to %s.\n' % (len(recent_intervals), self.trace_path))
+        self.write_stream.flush()
+
+
+
+class NullLight(Light):
+
+    # keeps the last frame and counts shows; for headless runs and benchmarks
+
+    def __init__(self, strip_size):
+
+        self.strip_size = strip_size
+        self.strip_frame = bytearray(strip_size * 3)
+
+        self.show_count = 0
+
+
     def size(self):
 
         return self.strip_size
@@ -95,32 +340,25 @@ class TimingLight(Light):
 
     def pixels(self):
 
+        strip_frame = self.strip_frame
+
         for pixel_index in xrange(self.strip_size):
-            yield (pixel_index, self.strip_colors[pixel_index])
+            yield (pixel_index, (strip_frame[pixel_index*3], strip_frame[pixel_index*3+1], strip_frame[pixel_index*3+2]))
 
 
     def set(self, pixel_index, pixel_color):
 
-        self.strip_colors[pixel_index] = pixel_color
+        self.strip_frame[pixel_index*3:pixel_index*3+3] = pixel_color
 
 
-    def show(self):
+    def set_frame(self, frame):
 
-        if not self.last_show_time:
-            self.last_show_time = time.time()
-        else:
-            delta_show_time = time.time() - self.last_show_time
+        self.strip_frame[:] = frame
 
-            if delta_show_time > 0.5:
-                self.last_show_time = None
-            else:
-                write_stream = self.write_stream
-                write_stream.write(self.write_prefix)
-                write_stream.write('%.0f ms = %.1f/s' % (delta_show_time * 1000.0, 1.0 / delta_show_time))
-                write_stream.write(self.write_suffix)
-                write_stream.flush()
 
-                self.last_show_time = time.time()
+    def show(self):
+
+        self.show_count += 1
 
 
 
@@ -130,16 +368,25 @@ class ConsoleLight(Light):
     channel_weights = (0.2989, 0.5870, 0.1140)
     interpolated_char = (u'\u0020', u'\u2591', u'\u2592', u'\u2593')
 
+    show_blocks = True
 
-    def __init__(self, strip_size, write_stream = sys.stdout, write_prefix = '', write_suffix = ''):
+    # escape codes per (R,G,B); cleared rather than trimmed when full, as
+    # frames rarely hold more distinct colors than that
+    encode_cache_size = 4096
+
+
+    def __init__(self, strip_size, write_stream = sys.stdout, write_prefix = '', write_suffix = '', truecolor = False):
 
         self.strip_size = strip_size
-        self.strip_colors = [(0,0,0) for pixel_index in xrange(strip_size)]
+        self.strip_frame = bytearray(strip_size * 3)
 
         self.write_stream = write_stream
         self.write_prefix = write_prefix
         self.write_suffix = write_suffix
 
+        self.truecolor = truecolor
+        self.encode_cache = {}
+
 
     def size(self):
 
@@ -148,44 +395,106 @@ class ConsoleLight(Light):
 
     def pixels(self):
 
+        strip_frame = self.strip_frame
+
         for pixel_index in xrange(self.strip_size):
-            yield (pixel_index, self.strip_colors[pixel_index])
+            yield (pixel_index, (strip_frame[pixel_index*3], strip_frame[pixel_index*3+1], strip_frame[pixel_index*3+2]))
 
 
     def set(self, pixel_index, pixel_color):
 
-        self.strip_colors[pixel_index] = pixel_color
+        self.strip_frame[pixel_index*3:pixel_index*3+3] = pixel_color
+
+
+    def set_frame(self, frame):
+
+        self.strip_frame[:] = frame
 
 
     def show(self):
 
-        write_stream = self.write_stream
-        write_stream.write(self.write_prefix)
+        frame_parts = [self.write_prefix]
+        frame_parts += self.encode_pixels(0, self.strip_size)
+        frame_parts += ['\033[m', self.write_suffix]
 
-        for pixel_index, pixel_color in self.pixels():
-            pixel_color_coord = [channel * 5.0/255.0 for channel in pixel_color]
-            pixel_color_index = [int(channel_coord + 0.5) for channel_coord in pixel_color_coord]
+        # one write per frame, however many pixels
+        self.write_stream.write(u''.join(frame_parts))
+        self.write_stream.flush()
 
-            weighted_deviation = [self.channel_weights[channel_index] * abs(pixel_color_coord[channel_index] - pixel_color_index[channel_index]) for channel_index in xrange(len(pixel_color))]
 
-            interpolated_channel_index = max(xrange(len(pixel_color)), key = lambda channel_index: weighted_deviation[channel_index])
-            interpolated_channel_offset = pixel_color_coord[interpolated_channel_index] - pixel_color_index[interpolated_channel_index]
+    def show_partial(self, pixel_start, pixel_stop):
 
-            interpolated_char_index = int(interpolated_channel_offset * len(self.interpolated_char))
+        frame_parts = []
 
-            if interpolated_char_index == 0:
-                background_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
-                write_stream.write('\033[48;5;%dm%s' % (background_color_slot, self.interpolated_char[interpolated_char_index]))
-            else:
-                pixel_color_index[interpolated_channel_index] = int(pixel_color_coord[interpolated_channel_index])
-                background_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
-                pixel_color_index[interpolated_channel_index] += 1
-                foreground_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
-                write_stream.write('\033[38;5;%dm\033[48;5;%dm%s' % (foreground_color_slot, background_color_slot, self.interpolated_char[interpolated_char_index]))
+        # return to the line written by the previous show, then skip unchanged pixels
+        write_line_count = self.write_suffix.count('\n')
+        if write_line_count:
+            frame_parts += ['\033[%dA' % write_line_count]
+        frame_parts += [self.write_prefix]
+        if pixel_start:
+            frame_parts += ['\033[%dC' % pixel_start]
 
-        write_stream.write('\033[m')
-        write_stream.write(self.write_suffix)
-        write_stream.flush()
+        frame_parts += self.encode_pixels(pixel_start, pixel_stop)
+        frame_parts += ['\033[m', self.write_suffix]
+
+        self.write_stream.write(u''.join(frame_parts))
+        self.write_stream.flush()
+
+
+    def encode_pixels(self, pixel_start, pixel_stop):
+
+        strip_frame = self.strip_frame
+        encode_cache = self.encode_cache
+
+        frame_parts = []
+        prev_pixel_escape = None
+
+        for pixel_offset in xrange(pixel_start * 3, pixel_stop * 3, 3):
+            pixel_key = str(strip_frame[pixel_offset:pixel_offset+3])
+
+            try:
+                pixel_escape, pixel_char = encode_cache[pixel_key]
+            except KeyError:
+                if len(encode_cache) >= self.encode_cache_size:
+                    encode_cache.clear()
+
+                pixel_escape, pixel_char = encode_cache[pixel_key] = self.encode_pixel(bytearray(pixel_key))
+
+            # colors stay set until changed, so runs of the same escape code are written once
+            if pixel_escape != prev_pixel_escape:
+                frame_parts += [pixel_escape]
+                prev_pixel_escape = pixel_escape
+
+            frame_parts += [pixel_char]
+
+        return frame_parts
+
+
+    def encode_pixel(self, pixel_color):
+
+        # -> (escape code, character)
+        if self.truecolor:
+            return ('\033[48;2;%d;%d;%dm' % tuple(pixel_color), self.interpolated_char[0])
+
+        pixel_color_coord = [channel * 5.0/255.0 for channel in pixel_color]
+        pixel_color_index = [int(channel_coord + 0.5) for channel_coord in pixel_color_coord]
+
+        weighted_deviation = [self.channel_weights[channel_index] * abs(pixel_color_coord[channel_index] - pixel_color_index[channel_index]) for channel_index in xrange(len(pixel_color))]
+
+        interpolated_channel_index = max(xrange(len(pixel_color)), key = lambda channel_index: weighted_deviation[channel_index])
+        interpolated_channel_offset = pixel_color_coord[interpolated_channel_index] - pixel_color_index[interpolated_channel_index]
+
+        interpolated_char_index = int(interpolated_channel_offset * len(self.interpolated_char))
+
+        if interpolated_char_index == 0:
+            background_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
+            return ('\033[48;5;%dm' % background_color_slot, self.interpolated_char[interpolated_char_index])
+        else:
+            pixel_color_index[interpolated_channel_index] = int(pixel_color_coord[interpolated_channel_index])
+            background_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
+            pixel_color_index[interpolated_channel_index] += 1
+            foreground_color_slot = 16 + 36 * pixel_color_index[0] + 6 * pixel_color_index[1] + pixel_color_index[2]
+            return ('\033[38;5;%dm\033[48;5;%dm' % (foreground_color_slot, background_color_slot), self.interpolated_char[interpolated_char_index])
 
 
 
@@ -199,6 +508,8 @@ class NeopixelLight(Light):
     strip_type_name  = 'WS2811'
     strip_type_order = 'GRB'
 
+    show_blocks = True
+
 
     def __init__(self, strip_size, strip_pin, strip_brightness = 255):
 
@@ -222,6 +533,13 @@ class NeopixelLight(Light):
 
         self.strip.begin()
 
+        # big-endian 0x00RRGGBB words, as expected by setPixelColor
+        self.strip_words = bytearray(strip_size * 4)
+        self.strip_words_format = '>%dI' % strip_size
+
+        # the binding's private pixel buffer, where this version has one
+        self.strip_led_data = getattr(self.strip, '_led_data', None)
+
 
     def size(self):
 
@@ -249,402 +567,4196 @@ class NeopixelLight(Light):
         self.strip.setPixelColor(pixel_index, (red << 16) | (green << 8) | blue)
 
 
+    def set_frame(self, frame):
+
+        strip_words = self.strip_words
+        strip_words[1::4] = frame[0::3]
+        strip_words[2::4] = frame[1::3]
+        strip_words[3::4] = frame[2::3]
+
+        pixel_color_values = struct.unpack(self.strip_words_format, strip_words)
+
+        # slice assignment still sets one pixel at a time, but skips the
+        # per-pixel bounds checks and method calls of setPixelColor
+        if self.strip_led_data is not None:
+            self.strip_led_data[0:self.strip_size] = pixel_color_values
+            return
+
+        for pixel_index, pixel_color_value in enumerate(pixel_color_values):
+            self.strip.setPixelColor(pixel_index, pixel_color_value)
+
+
     def show(self):
 
         self.strip.show()
 
 
 
-class LightController(object):
+class UDPLight(Light):
 
-    class Layer(object):
+    # pixels are kept in preallocated packets, one per range of pixels, and only
+    # the payload of each packet is rewritten; subclasses lay out the headers
 
-        def __init__(self, pixel_length, pixel_color, pixel_alpha_left, pixel_alpha_right, pixel_offset, pixel_offset_speed):
+    packet_header_length = 0
+    packet_pixel_count   = 0
 
-            self.pixel_offset       = pixel_offset
-            self.pixel_offset_speed = pixel_offset_speed
 
-            if pixel_length == 1:
-                self.pixel_alpha_colors = [
-                    (pixel_alpha_left if pixel_offset_speed > 0.0 else pixel_alpha_right,) + pixel_color]
+    def __init__(self, strip_size, address):
 
-            else:
-                pixel_alpha_gradient = (pixel_alpha_right - pixel_alpha_left) / (pixel_length - 1)
+        self.strip_size = strip_size
 
-                self.pixel_alpha_colors = [
-                    (pixel_alpha_left + pixel_alpha_gradient * pixel_index,) + pixel_color
-                        for pixel_index
-                        in xrange(pixel_length)]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.send_error_count = 0
 
+        self.sequence = 0
 
+        # (packet, pixel_start, pixel_stop, address)
+        self.packets = []
 
-    def __init__(self, light, step_rate = 0.0):
+        for packet_index, pixel_start in enumerate(xrange(0, strip_size, self.packet_pixel_count)):
+            pixel_stop = min(strip_size, pixel_start + self.packet_pixel_count)
+            self.packets += [(self.create_packet(packet_index, pixel_start, pixel_stop), pixel_start, pixel_stop, self.packet_address(packet_index, address))]
 
-        self.light = light
-        self.light_color = (0,0,0)
-        self.light_color_history = [self.light_color]
-        self.light_color_history_length = 16
 
-        self.step_rate = step_rate
+    def create_packet(self, packet_index, pixel_start, pixel_stop):
 
-        self.layers = []
-        self.layer_base_color = self.light_color
-        self.layer_thread = None
-        self.layer_thread_running = False
+        return bytearray(self.packet_header_length + (pixel_stop - pixel_start) * 3)
 
-        self.layer_condition_wait_step     = threading.Condition()
-        self.layer_condition_access_layers = threading.Condition()
 
+    def packet_address(self, packet_index, address):
 
-    def start(self):
+        return address
 
-        if not self.layer_thread:
-            self.layer_base_color = self.light_color
 
-            self.layer_thread_running = True
-            self.layer_thread = threading.Thread(target = self.layer_thread_proc)
-            self.layer_thread.start()
+    def size(self):
 
+        return self.strip_size
 
-    def stop(self):
 
-        if self.layer_thread:
-            self.layer_thread_running = False
+    def pixels(self):
 
-            self.layer_condition_wait_step.acquire()
-            self.layer_condition_wait_step.notify()
-            self.layer_condition_wait_step.release()
+        header_length = self.packet_header_length
 
-            self.layer_thread.join()
-            self.layer_thread = None
+        for packet, pixel_start, pixel_stop, address in self.packets:
+            for pixel_index in xrange(pixel_start, pixel_stop):
+                pixel_offset = header_length + (pixel_index - pixel_start) * 3
+                yield (pixel_index, (packet[pixel_offset], packet[pixel_offset+1], packet[pixel_offset+2]))
 
 
-    def layer_thread_proc(self):
+    def set(self, pixel_index, pixel_color):
 
-        range_length_left  = (self.light.strip_size + 1) // 2
-        range_length_right =  self.light.strip_size      // 2
+        packet, pixel_start, pixel_stop, address = self.packets[pixel_index // self.packet_pixel_count]
 
-        prev_step_time = time.time()
-        min_step_duration = (1.0 / self.step_rate if self.step_rate > 0.0 else 0.0)
+        pixel_offset = self.packet_header_length + (pixel_index - pixel_start) * 3
+        packet[pixel_offset:pixel_offset+3] = pixel_color
 
-        while self.layer_thread_running:
-            pixel_colors = None
-
-            self.layer_condition_access_layers.acquire()
-
-            if self.layers:
-                curr_step_time = time.time()
-                delta_step_time = curr_step_time - prev_step_time
-                prev_step_time = curr_step_time
-
-                for layer in self.layers:
-                    layer.pixel_offset += layer.pixel_offset_speed * delta_step_time
-
-                while self.layers:
-                    layer = self.layers[0]
-
-                    if layer.pixel_offset_speed < 0.0:
-                        # layer moves right to left
-                        if layer.pixel_offset + len(layer.pixel_alpha_colors) > 0.0:
-                            # right-hand part of layer visible on left-hand side
-                            break
-                        else:
-                            # final color at right end
-                            self.layer_base_color = layer.pixel_alpha_colors[-1][1:]
-                            self.layers.pop(0)
-                    else:
-                        # layer moves left to right
-                        if layer.pixel_offset < range_length_left:
-                            # left-hand part of layer visible on right-hand side
-                            break
-                        else:
-                            # layer moves left to right, final color at left end
-                            self.layer_base_color = layer.pixel_alpha_colors[0][1:]
-                            self.layers.pop(0)
-
-                pixel_colors = [
-                    tuple(int(channel)
-                        for channel
-                        in reduce(  # -> (R,G,B)
-                            lambda pixel_base_color, layer: (  # -> (R,G,B)
-                                lambda layer_pixel_alpha_color:  # -> (R,G,B)
-                                    tuple((1.0 - layer_pixel_alpha_color[0]) * pixel_base_color       [channel_index] +
-                                                 layer_pixel_alpha_color[0]  * layer_pixel_alpha_color[channel_index+1]
-                                        for channel_index
-                                        in xrange(len(pixel_base_color))))((
-                                lambda clamped_pixel_index: (  # -> (A,R,G,B)
-                                    layer.pixel_alpha_colors[int(clamped_pixel_index)]
-                                        if
-                                            clamped_pixel_index == int(clamped_pixel_index)
-                                        else
-                                    tuple((1.0 - (clamped_pixel_index - int(clamped_pixel_index))) * channel_left +
-                                                 (clamped_pixel_index - int(clamped_pixel_index))  * channel_right
-                                        for
-                                            channel_left,
-                                            channel_right
-                                        in zip(
-                                            layer.pixel_alpha_colors[int(clamped_pixel_index)],
-                                            layer.pixel_alpha_colors[int(clamped_pixel_index)+1]))))(
-                                max(0.0,
-                                min(len(layer.pixel_alpha_colors)-1.0,
-                                pixel_index - layer.pixel_offset)))),
-                            self.layers,
-                            self.layer_base_color))
-                    for pixel_index
-                    in xrange(range_length_left)]
 
-            self.layer_condition_access_layers.release()
+    def set_frame(self, frame):
 
-            if pixel_colors:
-                pixel_colors += pixel_colors[range_length_right-1::-1]
-                for pixel_index in xrange(len(pixel_colors)):
-                    self.light.set(pixel_index, pixel_colors[pixel_index])
-                self.light.show()
+        header_length = self.packet_header_length
 
-            if self.layer_thread_running:
-                if self.layers:
-                    # sleep for remainder of allocated step time
-                    self.layer_condition_wait_step.acquire()
-                    remaining_step_duration = min_step_duration - (time.time() - curr_step_time)
-                    if remaining_step_duration > 0.0:
-                        self.layer_condition_wait_step.wait(remaining_step_duration)
-                    self.layer_condition_wait_step.release()
-                else:
-                    # sleep until awakened
-                    self.layer_condition_wait_step.acquire()
-                    self.layer_condition_wait_step.wait()
-                    self.layer_condition_wait_step.release()
+        # memoryview slices, so that the frame is copied straight into the packets
+        frame_view = memoryview(frame)
 
-                    # restart step timing (otherwise next step delta includes sleep)
-                    prev_step_time = time.time()
+        for packet, pixel_start, pixel_stop, address in self.packets:
+            packet[header_length:] = frame_view[pixel_start*3:pixel_stop*3]
 
 
-    def set_light_color(self, light_color, transition_time = 0.0):
+    def show(self):
 
-        if light_color == self.light_color: return
+        self.send_packets(self.packets)
 
-        if transition_time <= 0.0:
-            # dummy layer that is instantly complete
-            layer = self.Layer(
-                pixel_length       = 1,
-                pixel_color        = light_color,
-                pixel_alpha_left   = 1.0,
-                pixel_alpha_right  = 1.0,
-                pixel_offset       = -1.0,
-                pixel_offset_speed = -1.0)
 
-        else:
-            range_length_left = (self.light.strip_size + 1) // 2
+    def show_partial(self, pixel_start, pixel_stop):
 
-            channel_weights = (0.2989, 0.5870, 0.1140)
-            old_light_color_lightness = sum(channel * channel_weight for channel, channel_weight in zip(self.light_color, channel_weights))
-            new_light_color_lightness = sum(channel * channel_weight for channel, channel_weight in zip(     light_color, channel_weights))
+        # receivers keep whatever they were last sent for the other packets
+        self.send_packets(self.packets[pixel_start // self.packet_pixel_count : (pixel_stop - 1) // self.packet_pixel_count + 1])
 
-            if new_light_color_lightness > old_light_color_lightness:
-                # fade in brighter colors from center to outside
-                layer = self.Layer(
-                    pixel_length       = range_length_left,
-                    pixel_color        = light_color,
-                    pixel_alpha_left   = 0.0,
-                    pixel_alpha_right  = 1.0,
-                    pixel_offset       = range_length_left,
-                    pixel_offset_speed = -range_length_left / float(transition_time))
-            else:
-                # fade in darker colors from outside to center
-                layer = self.Layer(
-                    pixel_length       = range_length_left,
-                    pixel_color        = light_color,
-                    pixel_alpha_left   = 1.0,
-                    pixel_alpha_right  = 0.0,
-                    pixel_offset       = -range_length_left,
-                    pixel_offset_speed = range_length_left / float(transition_time))
 
-        self.layer_condition_access_layers.acquire()
+    def close(self):
 
-        self.layers += [layer]
-        self.light_color = light_color
+        self.socket.close()
 
-        self.light_color_history += [light_color]
-        self.light_color_history = self.light_color_history[-self.light_color_history_length:]
 
-        if len(self.layers) == 1:
-            self.layer_condition_wait_step.acquire()
-            self.layer_condition_wait_step.notify()
-            self.layer_condition_wait_step.release()
+    def send_packets(self, packets):
 
-        self.layer_condition_access_layers.release()
+        self.sequence += 1
 
+        for packet_index, (packet, pixel_start, pixel_stop, address) in enumerate(packets):
+            self.update_packet(packet, self.sequence, packet_index == len(packets) - 1)
 
+            try:
+                self.socket.sendto(packet, address)
+            except socket.error:
+                # a lost frame is made up for by the next one
+                self.send_error_count += 1
 
-class LightManager(object):
 
-    def __init__(self, light_controller, cycle_light_colors, cycle_transition_time = 0.0, off_light_color = (0,0,0), off_transition_time = 0.0):
+    def update_packet(self, packet, sequence, packet_last):
 
-        self.light_controller = light_controller
+        pass
 
-        self.cycle_light_colors    = cycle_light_colors
-        self.cycle_transition_time = cycle_transition_time
-        self.off_light_color       = off_light_color
-        self.off_transition_time   = off_transition_time
 
 
-    def is_on(self):
+class DDPLight(UDPLight):
 
-        return (self.light_controller.light_color != self.off_light_color)
+    # Distributed Display Protocol: 10-byte header with the byte offset of the
+    # payload; the push flag on the last packet tells the receiver to show
 
+    default_port = 4048
 
-    def is_off(self):
+    packet_header_length = 10
+    packet_pixel_count   = 480
 
-        return (self.light_controller.light_color == self.off_light_color)
+    flags_version = 0x40
+    flags_push    = 0x01
+    data_type     = 0x0B  # RGB, 8 bits per channel
+    destination   = 0x01  # default output device
 
 
-    def switch_on(self):
+    def __init__(self, strip_size, host, port = None):
 
-        if self.is_off():
-            if len(self.light_controller.light_color_history) < 2:
-                on_light_color = self.cycle_light_colors[0]
-            else:
-                # last history color must be off, previous is most recent on
-                on_light_color = self.light_controller.light_color_history[-2]
+        UDPLight.__init__(self, strip_size, (host, port or self.default_port))
 
-            self.light_controller.set_light_color(on_light_color, self.cycle_transition_time)
+
+    def create_packet(self, packet_index, pixel_start, pixel_stop):
+
+        packet = UDPLight.create_packet(self, packet_index, pixel_start, pixel_stop)
+
+        struct.pack_into('>BBBBIH', packet, 0,
+            self.flags_version,
+            0,
+            self.data_type,
+            self.destination,
+            pixel_start * 3,
+            (pixel_stop - pixel_start) * 3)
+
+        return packet
+
+
+    def update_packet(self, packet, sequence, packet_last):
+
+        packet[0] = self.flags_version | (self.flags_push if packet_last else 0)
+        packet[1] = (sequence - 1) % 15 + 1  # 1..15, 0 means no sequence
+
+
+
+class E131Light(UDPLight):
+
+    # E1.31 (streaming ACN): one DMX universe of 170 pixels per packet, sent to
+    # the given host or to the universe's multicast group
+
+    default_port = 5568
+
+    packet_header_length = 126
+    packet_pixel_count   = 170
+
+    acn_packet_identifier = 'ASC-E1.17\0\0\0'
+    source_name = 'ambientlight'
+    priority = 100
+
+
+    def __init__(self, strip_size, host = None, port = None, universe_start = 1):
+
+        import uuid
+
+        self.universe_start = universe_start
+        self.cid = uuid.uuid4().bytes
+
+        UDPLight.__init__(self, strip_size, (host, port or self.default_port))
+
+
+    def packet_address(self, packet_index, address):
+
+        host, port = address
+        universe = self.universe_start + packet_index
+
+        if host is None:
+            host = '239.255.%d.%d' % (universe >> 8, universe & 0xFF)
+
+        return (host, port)
+
+
+    def create_packet(self, packet_index, pixel_start, pixel_stop):
+
+        packet = UDPLight.create_packet(self, packet_index, pixel_start, pixel_stop)
+        packet_length = len(packet)
+        channel_count = (pixel_stop - pixel_start) * 3
+
+        # root layer
+        struct.pack_into('>HH12sHI16s', packet, 0,
+            0x0010,
+            0x0000,
+            self.acn_packet_identifier,
+            0x7000 | (packet_length - 16),
+            0x00000004,
+            self.cid)
+
+        # framing layer; sequence number at 111 is set per packet
+        struct.pack_into('>HI64sBHBBH', packet, 38,
+            0x7000 | (packet_length - 38),
+            0x00000002,
+            self.source_name,
+            self.priority,
+            0,
+            0,
+            0,
+            self.universe_start + packet_index)
+
+        # DMP layer, DMX start code 0 followed by the channels
+        struct.pack_into('>HBBHHHB', packet, 115,
+            0x7000 | (packet_length - 115),
+            0x02,
+            0xA1,
+            0x0000,
+            0x0001,
+            channel_count + 1,
+            0x00)
+
+        return packet
+
+
+    def update_packet(self, packet, sequence, packet_last):
+
+        packet[111] = sequence & 0xFF
+
+
+
+class UDPPixelReceiver(object):
+
+    # stands in for a networked pixel controller: decodes DDP or E1.31 packets
+    # into a light, showing it once no more packets are waiting
+
+    def __init__(self, light, protocol, address = ('', None), universe_start = 1):
+
+        self.light = light
+        self.protocol = protocol
+        self.universe_start = universe_start
+
+        self.frame = bytearray(light.strip_size * 3)
+        self.packet = bytearray(65536)
+
+        default_port = {'ddp': DDPLight.default_port, 'e131': E131Light.default_port}[protocol]
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((address[0], address[1] or default_port))
+
+        self.packet_count = 0
+        self.show_count = 0
+
+
+    def join_multicast_groups(self, interface_address = '0.0.0.0'):
+
+        for universe in xrange(self.universe_start, self.universe_start + (len(self.frame) // 3 + E131Light.packet_pixel_count - 1) // E131Light.packet_pixel_count):
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                socket.inet_aton('239.255.%d.%d' % (universe >> 8, universe & 0xFF)) + socket.inet_aton(interface_address))
+
+
+    def receive(self, timeout = None):
+
+        # blocks for the first packet, then takes whatever else has arrived
+        self.socket.settimeout(timeout)
+
+        try:
+            self.receive_packet()
+        except socket.timeout:
+            return False
+
+        self.socket.settimeout(0.0)
+
+        try:
+            while True:
+                self.receive_packet()
+        except socket.error as error:
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        self.light.set_frame(self.frame)
+        self.light.show()
+        self.show_count += 1
+
+        return True
+
+
+    def receive_packet(self):
+
+        packet = self.packet
+        packet_length = self.socket.recv_into(packet)
+
+        if self.protocol == 'ddp':
+            if packet_length < DDPLight.packet_header_length:
+                return
+            header_length = DDPLight.packet_header_length
+            data_offset, data_length = struct.unpack_from('>IH', packet, 4)
+
+        else:
+            if packet_length < E131Light.packet_header_length or packet[4:16] != E131Light.acn_packet_identifier:
+                return
+            header_length = E131Light.packet_header_length
+            universe, = struct.unpack_from('>H', packet, 113)
+            data_offset = (universe - self.universe_start) * E131Light.packet_pixel_count * 3
+            data_length = packet_length - header_length
+
+        # anything beyond the strip is dropped
+        data_length = max(0, min(data_length, packet_length - header_length, len(self.frame) - data_offset))
+        if data_offset >= 0 and data_length:
+            self.frame[data_offset:data_offset+data_length] = packet[header_length:header_length+data_length]
+
+        self.packet_count += 1
+
+
+
+class FrameRing(object):
+
+    # frames passed between processes through a shared anonymous mapping; each
+    # slot carries the sequence number of the frame in it, and the header the
+    # sequence number of the newest frame
+
+    header_format = '<QQQ'  # newest sequence, closed, skipped step count
+    slot_format   = '<Q'   # sequence, followed by the frame
+
+
+    def __init__(self, strip_size, slot_count = 4):
+
+        import mmap
+
+        self.frame_size = strip_size * 3
+        self.slot_count = slot_count
+
+        self.header_size = struct.calcsize(self.header_format)
+        self.slot_size   = struct.calcsize(self.slot_format) + self.frame_size
+
+        # created before forking, so that all processes map the same pages
+        self.buffer = mmap.mmap(-1, self.header_size + slot_count * self.slot_size)
+
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        fcntl.fcntl(self.wakeup_write_fd, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        # each process keeps its own copy of these
+        self.write_sequence = 0
+        self.read_sequence = 0
+        self.dropped_frame_count = 0
+        self.write_skip_count = 0
+        self.read_skip_count = 0
+
+
+    def slot_offset(self, sequence):
+
+        return self.header_size + (sequence % self.slot_count) * self.slot_size
+
+
+    def write(self, frame):
+
+        sequence = self.write_sequence + 1
+        slot_offset = self.slot_offset(sequence)
+        frame_offset = slot_offset + struct.calcsize(self.slot_format)
+
+        # zero while the frame is being written, so that readers can tell
+        struct.pack_into(self.slot_format, self.buffer, slot_offset, 0)
+        self.buffer[frame_offset:frame_offset+self.frame_size] = str(frame)
+        struct.pack_into(self.slot_format, self.buffer, slot_offset, sequence)
+
+        struct.pack_into('<Q', self.buffer, 0, sequence)
+        self.write_sequence = sequence
+
+        self.wakeup()
+
+
+    def skip(self):
+
+        # no wakeup; the reader learns of it with the next frame
+        self.write_skip_count += 1
+        struct.pack_into('<Q', self.buffer, 16, self.write_skip_count)
+
+
+    def skipped(self):
+
+        # whether steps were skipped since the last call
+        skip_count = struct.unpack_from(self.header_format, self.buffer, 0)[2]
+        skipped = (skip_count != self.read_skip_count)
+        self.read_skip_count = skip_count
+
+        return skipped
+
+
+    def read(self, frame):
+
+        # newest frame into frame; False if there is none since the last read
+        while True:
+            sequence, closed, skip_count = struct.unpack_from(self.header_format, self.buffer, 0)
+
+            if sequence == self.read_sequence:
+                return False
+
+            slot_offset = self.slot_offset(sequence)
+            frame_offset = slot_offset + struct.calcsize(self.slot_format)
+
+            frame[:] = self.buffer[frame_offset:frame_offset+self.frame_size]
+
+            # the writer may have lapped the ring while the frame was copied
+            if struct.unpack_from(self.slot_format, self.buffer, slot_offset)[0] == sequence:
+                break
+
+        self.dropped_frame_count += sequence - self.read_sequence - 1
+        self.read_sequence = sequence
+
+        return True
+
+
+    def wait(self, timeout):
+
+        try:
+            readable_fds, writable_fds, error_fds = select.select([self.wakeup_read_fd], [], [], timeout)
+        except select.error as error:
+            # a signal handler ran, such as SIGUSR1 asking for a trace
+            if error.args[0] == errno.EINTR:
+                return
+            raise
+
+        if readable_fds:
+            os.read(self.wakeup_read_fd, 4096)
+
+
+    def wakeup(self):
+
+        try:
+            os.write(self.wakeup_write_fd, 'x')
+        except OSError as error:
+            # pipe full, reader is awake anyway
+            if error.errno != errno.EAGAIN:
+                raise
+
+
+    def close(self):
+
+        struct.pack_into('<Q', self.buffer, 8, 1)
+        self.wakeup()
+
+
+    def closed(self):
+
+        return struct.unpack_from(self.header_format, self.buffer, 0)[1] != 0
+
+
+
+class FrameRingLight(NullLight):
+
+    # compositing side of a frame ring; shown frames go to the output process
+
+    def __init__(self, frame_ring):
+
+        NullLight.__init__(self, frame_ring.frame_size // 3)
+
+        self.frame_ring = frame_ring
+
+
+    def show(self):
+
+        self.frame_ring.write(self.strip_frame)
+        self.show_count += 1
+
+
+    def skip_show(self):
+
+        self.frame_ring.skip()
+
+
+    def close(self):
+
+        self.frame_ring.close()
+
+
+
+class RecordingLight(Light):
+
+    # wraps another light and appends every shown frame, with the time it was
+    # shown, to a capture file; the file is mapped and grown a chunk of frames
+    # at a time, so that recording a frame is a copy into memory
+
+    capture_magic  = 'ALCAPTR1'
+    header_format  = '<8sIIQ'  # magic, header size, strip size, frame count
+    record_format  = '<d'      # show time, followed by the frame
+
+    chunk_frame_count = 1024
+
+
+    def __init__(self, light, capture_path, clock = None):
+
+        import mmap
+
+        self.light = light
+        self.strip_size = light.strip_size
+        self.strip_frame = bytearray(self.strip_size * 3)
+        self.show_blocks = light.show_blocks
+
+        self.clock = clock or monotonic_time
+
+        self.header_size = struct.calcsize(self.header_format)
+        self.record_size = struct.calcsize(self.record_format) + self.strip_size * 3
+
+        self.capture_file = open(capture_path, 'w+b')
+        self.capture_file.truncate(self.header_size + self.chunk_frame_count * self.record_size)
+        self.capture_buffer = mmap.mmap(self.capture_file.fileno(), 0)
+
+        self.frame_count = 0
+        struct.pack_into(self.header_format, self.capture_buffer, 0, self.capture_magic, self.header_size, self.strip_size, self.frame_count)
+
+
+    def size(self):
+
+        return self.light.size()
+
+
+    def pixels(self):
+
+        return self.light.pixels()
+
+
+    def set(self, pixel_index, pixel_color):
+
+        self.strip_frame[pixel_index*3:pixel_index*3+3] = pixel_color
+        self.light.set(pixel_index, pixel_color)
+
+
+    def set_frame(self, frame):
+
+        self.strip_frame[:] = frame
+        self.light.set_frame(frame)
+
+
+    def show(self):
+
+        self.record_frame()
+        self.light.show()
+
+
+    def show_partial(self, pixel_start, pixel_stop):
+
+        # recorded in full, so that every frame in the capture stands on its own
+        self.record_frame()
+        self.light.show_partial(pixel_start, pixel_stop)
+
+
+    def skip_show(self):
+
+        self.light.skip_show()
+
+
+    def record_frame(self):
+
+        record_offset = self.header_size + self.frame_count * self.record_size
+
+        if record_offset + self.record_size > len(self.capture_buffer):
+            self.capture_buffer.resize(len(self.capture_buffer) + self.chunk_frame_count * self.record_size)
+
+        struct.pack_into(self.record_format, self.capture_buffer, record_offset, self.clock())
+
+        frame_offset = record_offset + struct.calcsize(self.record_format)
+        self.capture_buffer[frame_offset:frame_offset+len(self.strip_frame)] = str(self.strip_frame)
+
+        # readers never see more frames than have been written in full
+        self.frame_count += 1
+        struct.pack_into('<Q', self.capture_buffer, 16, self.frame_count)
+
+
+    def close(self):
+
+        if self.capture_buffer:
+            self.capture_buffer.close()
+            self.capture_buffer = None
+
+            # drop the unused rest of the last chunk
+            self.capture_file.truncate(self.header_size + self.frame_count * self.record_size)
+            self.capture_file.close()
+
+        self.light.close()
+
+
+
+class FrameCapture(object):
+
+    # read side of a RecordingLight capture file
+
+    def __init__(self, capture_path):
+
+        import mmap
+
+        self.capture_file = open(capture_path, 'rb')
+        self.capture_buffer = mmap.mmap(self.capture_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        header_format = RecordingLight.header_format
+
+        if len(self.capture_buffer) < struct.calcsize(header_format):
+            raise ValueError('not a frame capture: %s' % capture_path)
+
+        capture_magic, self.header_size, self.strip_size, self.frame_count = struct.unpack_from(header_format, self.capture_buffer, 0)
+
+        if capture_magic != RecordingLight.capture_magic:
+            raise ValueError('not a frame capture: %s' % capture_path)
+
+        self.record_size = struct.calcsize(RecordingLight.record_format) + self.strip_size * 3
+
+        # a capture cut short by a crash still holds the frames counted in its header
+        self.frame_count = min(self.frame_count, (len(self.capture_buffer) - self.header_size) // self.record_size)
+
+
+    def frames(self):
+
+        # -> (show time, frame)
+        frame_offset_delta = struct.calcsize(RecordingLight.record_format)
+
+        for frame_index in xrange(self.frame_count):
+            record_offset = self.header_size + frame_index * self.record_size
+            frame_offset = record_offset + frame_offset_delta
+
+            show_time, = struct.unpack_from(RecordingLight.record_format, self.capture_buffer, record_offset)
+
+            yield (show_time, bytearray(self.capture_buffer[frame_offset:frame_offset+self.strip_size*3]))
+
+
+    def close(self):
+
+        self.capture_buffer.close()
+        self.capture_file.close()
+
+
+
+def replay_capture(frame_capture, light, speed = 1.0):
+
+    # shows the captured frames on light, spaced as they were recorded and sped
+    # up by speed; a speed of 0 shows them back to back
+    if frame_capture.strip_size != light.strip_size:
+        raise ValueError('capture is for %d pixels, light has %d' % (frame_capture.strip_size, light.strip_size))
+
+    replay_start_time = monotonic_time()
+    first_show_time = None
+
+    for show_time, frame in frame_capture.frames():
+        if first_show_time is None:
+            first_show_time = show_time
+
+        if speed > 0.0:
+            sleep_duration = replay_start_time + (show_time - first_show_time) / speed - monotonic_time()
+            if sleep_duration > 0.0:
+                time.sleep(sleep_duration)
+
+        light.set_frame(frame)
+        light.show()
+
+    return frame_capture.frame_count
+
+
+
+class PixelMap(object):
+
+    # where each composited pixel is shown on the strip, possibly in several
+    # places; compiled into slices that copy whole runs of pixels at once
+
+    def __init__(self, pixel_indices):
+
+        # pixel_indices[pixel_index] -> strip pixel indices
+        self.pixel_count = len(pixel_indices)
+        self.pixel_indices = pixel_indices
+
+        self.pixel_index_mins = [min(strip_pixel_indices) for strip_pixel_indices in pixel_indices]
+        self.pixel_index_maxs = [max(strip_pixel_indices) for strip_pixel_indices in pixel_indices]
+
+        self.scatter_slices = self.compile_scatter_slices(pixel_indices)
+
+
+    @classmethod
+    def from_segments(cls, segments, mirror = False):
+
+        # segments of (pixel_start, pixel_count, reverse) are joined into one run;
+        # mirrored runs show the first pixel at both ends and the last in the middle
+        run_pixel_indices = []
+
+        for pixel_start, pixel_count, reverse in segments:
+            segment_pixel_indices = range(pixel_start, pixel_start + pixel_count)
+            run_pixel_indices += (segment_pixel_indices[::-1] if reverse else segment_pixel_indices)
+
+        if mirror:
+            run_length = len(run_pixel_indices)
+            return cls([
+                sorted(set([run_pixel_indices[pixel_index], run_pixel_indices[run_length - 1 - pixel_index]]))
+                    for pixel_index
+                    in xrange((run_length + 1) // 2)])
+        else:
+            return cls([[strip_pixel_index] for strip_pixel_index in run_pixel_indices])
+
+
+    @classmethod
+    def mirrored(cls, strip_size):
+
+        # the layout of a single strip lit from the center out
+        return cls.from_segments([(0, strip_size, False)], mirror = True)
+
+
+    @staticmethod
+    def compile_scatter_slices(pixel_indices):
+
+        # runs of consecutive pixels shown on consecutive strip pixels, in either
+        # direction, as (pixel_start, strip_pixel_start, run_length, direction)
+        runs = []
+
+        for copy_index in xrange(max(len(strip_pixel_indices) for strip_pixel_indices in pixel_indices) if pixel_indices else 0):
+            for pixel_index, strip_pixel_indices in enumerate(pixel_indices):
+                if copy_index >= len(strip_pixel_indices):
+                    continue
+
+                strip_pixel_index = strip_pixel_indices[copy_index]
+
+                if runs:
+                    run_pixel_start, run_strip_pixel_start, run_length, run_direction = runs[-1]
+                    strip_pixel_step = strip_pixel_index - (run_strip_pixel_start + (run_length - 1) * run_direction)
+
+                    if pixel_index == run_pixel_start + run_length and (strip_pixel_step == run_direction or run_length == 1 and strip_pixel_step in (1, -1)):
+                        runs[-1] = (run_pixel_start, run_strip_pixel_start, run_length + 1, strip_pixel_step)
+                        continue
+
+                runs += [(pixel_index, strip_pixel_index, 1, 1)]
+
+        # -> (strip frame slice, frame slice)
+        scatter_slices = []
+
+        for pixel_start, strip_pixel_start, run_length, direction in runs:
+            if direction > 0:
+                scatter_slices += [(slice(strip_pixel_start*3, (strip_pixel_start + run_length)*3), slice(pixel_start*3, (pixel_start + run_length)*3))]
+            else:
+                # channel by channel, from the last pixel of the run backwards
+                strip_pixel_first = strip_pixel_start - run_length + 1
+                for channel_index in xrange(3):
+                    pixel_stop_offset = pixel_start*3 + channel_index - 3
+                    scatter_slices += [(
+                        slice(strip_pixel_first*3 + channel_index, (strip_pixel_start + 1)*3, 3),
+                        slice((pixel_start + run_length - 1)*3 + channel_index, (pixel_stop_offset if pixel_stop_offset >= 0 else None), -3))]
+
+        return scatter_slices
+
+
+    def scatter(self, frame, strip_frame):
+
+        for strip_frame_slice, frame_slice in self.scatter_slices:
+            strip_frame[strip_frame_slice] = frame[frame_slice]
+
+
+    def strip_pixel_span(self, pixel_start, pixel_stop):
+
+        # strip pixels covering everything shown for the given pixels
+        return (min(self.pixel_index_mins[pixel_start:pixel_stop]), max(self.pixel_index_maxs[pixel_start:pixel_stop]) + 1)
+
+
+
+class MappedLight(Light):
+
+    # takes frames as composited and shows them on a light laid out by a pixel
+    # map; the mapped lights of several zones scatter into one ZoneStrip, which
+    # shows them all at once
+
+    def __init__(self, light, pixel_map, zone_strip = None):
+
+        self.light = light
+        self.pixel_map = pixel_map
+
+        self.strip_size = pixel_map.pixel_count
+        self.frame = bytearray(self.strip_size * 3)
+
+        self.zone_strip  = zone_strip
+        self.strip_frame = (zone_strip.strip_frame if zone_strip else bytearray(light.strip_size * 3))
+
+
+    def size(self):
+
+        return self.strip_size
+
+
+    def pixels(self):
+
+        frame = self.frame
+
+        for pixel_index in xrange(self.strip_size):
+            yield (pixel_index, (frame[pixel_index*3], frame[pixel_index*3+1], frame[pixel_index*3+2]))
+
+
+    def set(self, pixel_index, pixel_color):
+
+        self.frame[pixel_index*3:pixel_index*3+3] = pixel_color
+
+        for strip_pixel_index in self.pixel_map.pixel_indices[pixel_index]:
+            self.strip_frame[strip_pixel_index*3:strip_pixel_index*3+3] = pixel_color
+
+
+    def set_frame(self, frame):
+
+        self.frame[:] = frame
+
+        self.pixel_map.scatter(frame, self.strip_frame)
+
+
+    def show(self):
+
+        if self.zone_strip:
+            self.zone_strip.mark_pixel_span(None)
+            return
+
+        self.light.set_frame(self.strip_frame)
+        self.light.show()
+
+
+    def show_partial(self, pixel_start, pixel_stop):
+
+        if self.zone_strip:
+            self.zone_strip.mark_pixel_span(self.pixel_map.strip_pixel_span(pixel_start, pixel_stop))
+            return
+
+        self.light.set_frame(self.strip_frame)
+        self.light.show_partial(*self.pixel_map.strip_pixel_span(pixel_start, pixel_stop))
+
+
+    def skip_show(self):
+
+        # the strip is skipped only if no zone shows anything
+        if not self.zone_strip:
+            self.light.skip_show()
+
+
+    def close(self):
+
+        self.light.close()
+
+
+
+class ZoneStrip(object):
+
+    # strip frame shared by the mapped lights of all zones; they only scatter
+    # into it and mark what changed, and the ZoneRenderLoop stepping them shows
+    # it once per step, over the union of the marked pixels
+
+    def __init__(self, light):
+
+        self.light = light
+        self.strip_frame = bytearray(light.strip_size * 3)
+
+        # marked since the last show: all pixels, or a (start, stop) span
+        self.show_all = False
+        self.pixel_span = None
+
+
+    def mark_pixel_span(self, pixel_span):
+
+        if pixel_span is None:
+            self.show_all = True
+        elif self.pixel_span is None:
+            self.pixel_span = pixel_span
+        else:
+            self.pixel_span = (min(self.pixel_span[0], pixel_span[0]), max(self.pixel_span[1], pixel_span[1]))
+
+
+    def show(self):
+
+        if self.show_all:
+            self.light.set_frame(self.strip_frame)
+            self.light.show()
+
+        elif self.pixel_span is not None:
+            self.light.set_frame(self.strip_frame)
+            self.light.show_partial(*self.pixel_span)
+
+        else:
+            self.light.skip_show()
+
+        self.show_all = False
+        self.pixel_span = None
+
+
+
+class BackgroundShowLight(Light):
+
+    # hands shown frames to a thread of its own that shows them on the wrapped
+    # light, so that callers never wait on a driver whose show blocks; a frame
+    # still pending when the next one is shown is overtaken by it
+
+    def __init__(self, light):
+
+        self.light = light
+        self.strip_size = light.strip_size
+        self.strip_frame = bytearray(self.strip_size * 3)
+
+        # (frame, pixel span or None for all pixels) not yet shown
+        self.pending_frame = None
+        self.pending_pixel_span = None
+
+        # steps skipped before the pending frame, passed on just ahead of it
+        self.skipped = False
+        self.pending_skipped = False
+
+        self.overtaken_frame_count = 0
+
+        self.show_condition = threading.Condition()
+        self.show_thread_running = True
+
+        self.show_thread = threading.Thread(target = self.show_thread_proc)
+        self.show_thread.daemon = True
+        self.show_thread.start()
+
+
+    def size(self):
+
+        return self.strip_size
+
+
+    def pixels(self):
+
+        frame = self.strip_frame
+
+        for pixel_index in xrange(self.strip_size):
+            yield (pixel_index, (frame[pixel_index*3], frame[pixel_index*3+1], frame[pixel_index*3+2]))
+
+
+    def set(self, pixel_index, pixel_color):
+
+        self.strip_frame[pixel_index*3:pixel_index*3+3] = pixel_color
+
+
+    def set_frame(self, frame):
+
+        self.strip_frame[:] = frame
+
+
+    def show(self):
+
+        self.queue_frame(None)
+
+
+    def show_partial(self, pixel_start, pixel_stop):
+
+        self.queue_frame((pixel_start, pixel_stop))
+
+
+    def skip_show(self):
+
+        # caller's thread only, like set_frame
+        self.skipped = True
+
+
+    def queue_frame(self, pixel_span):
+
+        self.show_condition.acquire()
+
+        skipped = self.skipped
+
+        if self.pending_frame is not None:
+            self.overtaken_frame_count += 1
+
+            # whatever the overtaken frame changed must still go out
+            if self.pending_pixel_span is None or pixel_span is None:
+                pixel_span = None
+            else:
+                pixel_span = (min(pixel_span[0], self.pending_pixel_span[0]), max(pixel_span[1], self.pending_pixel_span[1]))
+
+            skipped = skipped or self.pending_skipped
+
+        self.pending_frame = bytearray(self.strip_frame)
+        self.pending_pixel_span = pixel_span
+        self.pending_skipped = skipped
+        self.skipped = False
+
+        self.show_condition.notify()
+        self.show_condition.release()
+
+
+    def show_thread_proc(self):
+
+        while True:
+            self.show_condition.acquire()
+
+            while self.pending_frame is None and self.show_thread_running:
+                self.show_condition.wait()
+
+            frame, pixel_span, skipped = self.pending_frame, self.pending_pixel_span, self.pending_skipped
+            self.pending_frame = None
+
+            self.show_condition.release()
+
+            if frame is None:
+                break
+
+            if skipped:
+                self.light.skip_show()
+
+            self.light.set_frame(frame)
+
+            if pixel_span is None:
+                self.light.show()
+            else:
+                self.light.show_partial(*pixel_span)
+
+
+    def close(self):
+
+        # pending frames are still shown before the wrapped light is closed
+        self.show_condition.acquire()
+        self.show_thread_running = False
+        self.show_condition.notify()
+        self.show_condition.release()
+
+        self.show_thread.join()
+
+        self.light.close()
+
+
+
+def changed_pixel_span(frame, prev_frame, pixel_size = 3):
+
+    # -> (pixel start, pixel stop) around all pixels that differ between the two
+    # frames, or None if they are the same; narrowed down by binary search on
+    # slice equality, so that unchanged pixels are only ever compared in C
+    if frame == prev_frame:
+        return None
+
+    pixel_count = len(frame) // pixel_size
+
+    pixel_start_min, pixel_start_max = 0, pixel_count - 1
+    while pixel_start_min < pixel_start_max:
+        pixel_start_mid = (pixel_start_min + pixel_start_max + 1) // 2
+        if frame[:pixel_start_mid*pixel_size] == prev_frame[:pixel_start_mid*pixel_size]:
+            pixel_start_min = pixel_start_mid
+        else:
+            pixel_start_max = pixel_start_mid - 1
+
+    pixel_stop_min, pixel_stop_max = pixel_start_min + 1, pixel_count
+    while pixel_stop_min < pixel_stop_max:
+        pixel_stop_mid = (pixel_stop_min + pixel_stop_max) // 2
+        if frame[pixel_stop_mid*pixel_size:] == prev_frame[pixel_stop_mid*pixel_size:]:
+            pixel_stop_max = pixel_stop_mid
+        else:
+            pixel_stop_min = pixel_stop_mid + 1
+
+    return (pixel_start_min, pixel_stop_min)
+
+
+
+class PowerLimitedLight(Light):
+
+    # wraps another light and estimates the current it draws from a running sum
+    # per channel, updated over the pixels that changed only; frames that would
+    # draw more than the budget are dimmed evenly until they fit
+
+    # mA per pixel with one channel at full intensity, fitted to the colors
+    # measured at the end of this file on a strip of 57 pixels
+    default_channel_milliamps = (19.42, 11.82, 11.92)
+
+    # dimmed frames go through one of this many translation tables
+    scale_level_count = 256
+
+
+    def __init__(self, light, budget_amps, channel_milliamps = None):
+
+        self.light = light
+        self.strip_size = light.strip_size
+        self.show_blocks = light.show_blocks
+
+        self.budget_amps = budget_amps
+        self.channel_amps = [milliamps / 255.0 / 1000.0 for milliamps in (channel_milliamps or self.default_channel_milliamps)]
+
+        # frame as given, and the sum of each channel over its pixels
+        self.frame = bytearray(self.strip_size * 3)
+        self.channel_sums = [0, 0, 0]
+
+        self.estimated_amps = 0.0
+        self.limited_amps = 0.0
+
+        self.scale_level = self.scale_level_count
+        self.shown_scale_level = None
+        self.scale_tables = {}
+
+
+    def size(self):
+
+        return self.strip_size
+
+
+    def pixels(self):
+
+        frame = self.frame
+
+        for pixel_index in xrange(self.strip_size):
+            yield (pixel_index, (frame[pixel_index*3], frame[pixel_index*3+1], frame[pixel_index*3+2]))
+
+
+    def set(self, pixel_index, pixel_color):
+
+        for channel_index in xrange(3):
+            self.channel_sums[channel_index] += pixel_color[channel_index] - self.frame[pixel_index*3+channel_index]
+
+        self.frame[pixel_index*3:pixel_index*3+3] = pixel_color
+
+        self.update_estimate()
+
+
+    def set_frame(self, frame):
+
+        changed_span = changed_pixel_span(frame, self.frame)
+        if not changed_span:
+            return
+
+        byte_start, byte_stop = changed_span[0] * 3, changed_span[1] * 3
+
+        for channel_index in xrange(3):
+            self.channel_sums[channel_index] += (
+                sum(frame     [byte_start+channel_index:byte_stop:3]) -
+                sum(self.frame[byte_start+channel_index:byte_stop:3]))
+
+        self.frame[byte_start:byte_stop] = frame[byte_start:byte_stop]
+
+        self.update_estimate()
+
+
+    def update_estimate(self):
+
+        self.estimated_amps = sum(channel_sum * channel_amps for channel_sum, channel_amps in zip(self.channel_sums, self.channel_amps))
+
+        if self.estimated_amps > self.budget_amps:
+            # rounded down, so that the dimmed frame stays within budget
+            self.scale_level = int(self.scale_level_count * self.budget_amps / self.estimated_amps)
+        else:
+            self.scale_level = self.scale_level_count
+
+        self.limited_amps = self.estimated_amps * self.scale_level / self.scale_level_count
+
+
+    def limited_frame(self):
+
+        scale_level = self.scale_level
+
+        if scale_level == self.scale_level_count:
+            return self.frame
+
+        try:
+            scale_table = self.scale_tables[scale_level]
+        except KeyError:
+            scale_table = self.scale_tables[scale_level] = str(bytearray(channel * scale_level // self.scale_level_count for channel in xrange(256)))
+
+        return self.frame.translate(scale_table)
+
+
+    def show(self):
+
+        self.shown_scale_level = self.scale_level
+
+        self.light.set_frame(self.limited_frame())
+        self.light.show()
+
+
+    def show_partial(self, pixel_start, pixel_stop):
+
+        if self.scale_level != self.shown_scale_level:
+            # dimmed differently, all pixels change
+            self.show()
+            return
+
+        self.light.set_frame(self.limited_frame())
+        self.light.show_partial(pixel_start, pixel_stop)
+
+
+    def skip_show(self):
+
+        self.light.skip_show()
+
+
+    def power_state(self):
+
+        return collections.OrderedDict((
+            ('estimated_amps', round(self.estimated_amps, 3)),
+            ('limited_amps',   round(self.limited_amps, 3)),
+            ('budget_amps',    round(self.budget_amps, 3)),
+            ('headroom_amps',  round(self.budget_amps - self.limited_amps, 3)),
+        ))
+
+
+    def close(self):
+
+        self.light.close()
+
+
+
+def load_zone_pixel_maps(zones_path, strip_size):
+
+    # [{"name": "desk", "segments": [{"start": 0, "length": 30, "reverse": false}, ...], "mirror": true}, ...]
+    with open(zones_path) as zones_file:
+        zone_specs = json.load(zones_file)
+
+    zone_pixel_maps = collections.OrderedDict()
+
+    # zone name by strip pixel, for the zones compiled so far
+    strip_pixel_zone_names = [None] * strip_size
+
+    for zone_spec in zone_specs:
+        zone_name = zone_spec['name']
+
+        if not re.match(r'^[-\w]+$', zone_name) or zone_name in ('events', 'batch'):
+            raise ValueError('invalid zone name: %s' % zone_name)
+        if zone_name in zone_pixel_maps:
+            raise ValueError('duplicate zone name: %s' % zone_name)
+
+        segments = []
+
+        for segment_spec in zone_spec['segments']:
+            pixel_start = int(segment_spec['start'])
+            pixel_count = int(segment_spec['length'])
+
+            if pixel_start < 0 or pixel_count < 1 or pixel_start + pixel_count > strip_size:
+                raise ValueError('zone %s: segment %d+%d outside of %d pixels' % (zone_name, pixel_start, pixel_count, strip_size))
+
+            # two zones scattering into one pixel would flicker between them
+            for strip_pixel_index in xrange(pixel_start, pixel_start + pixel_count):
+                if strip_pixel_zone_names[strip_pixel_index] is not None:
+                    raise ValueError('zone %s: segment %d+%d overlaps zone %s' % (zone_name, pixel_start, pixel_count, strip_pixel_zone_names[strip_pixel_index]))
+
+            segments += [(pixel_start, pixel_count, bool(segment_spec.get('reverse', False)))]
+
+        if not segments:
+            raise ValueError('zone %s: no segments' % zone_name)
+
+        for pixel_start, pixel_count, reverse in segments:
+            strip_pixel_zone_names[pixel_start:pixel_start + pixel_count] = [zone_name] * pixel_count
+
+        zone_pixel_maps[zone_name] = PixelMap.from_segments(segments, mirror = bool(zone_spec.get('mirror', False)))
+
+    if not zone_pixel_maps:
+        raise ValueError('no zones in %s' % zones_path)
+
+    return zone_pixel_maps
+
+
+
+class PythonCompositor(object):
+
+    name = 'python'
+
+
+    def __init__(self, table_sampling = False, high_precision = False):
+
+        self.table_sampling = table_sampling
+
+        # high precision frames hold 16 bit channels (0..65535 for 0..255) in
+        # native byte order, for a color correction to take down to 8 bits
+        self.high_precision = high_precision
+        self.channel_size = (2 if high_precision else 1)
+
+
+    def encode_channels(self, channels):
+
+        if self.high_precision:
+            return bytearray(array.array('H', [int(channel * 257.0) for channel in channels]).tostring())
+
+        return bytearray(int(channel) for channel in channels)
+
+
+    def compose(self, layers, base_color, pixel_start, pixel_stop):
+
+        if self.table_sampling:
+            return self.compose_table(layers, base_color, pixel_start, pixel_stop)
+
+        return self.encode_channels(
+            channel
+                for pixel_index
+                in xrange(pixel_start, pixel_stop)
+                for channel
+                in reduce(  # -> (R,G,B)
+                    lambda pixel_base_color, layer: (  # -> (R,G,B)
+                        lambda layer_pixel_alpha_color:  # -> (R,G,B)
+                            tuple((1.0 - layer_pixel_alpha_color[0]) * pixel_base_color       [channel_index] +
+                                         layer_pixel_alpha_color[0]  * layer_pixel_alpha_color[channel_index+1]
+                                for channel_index
+                                in xrange(len(pixel_base_color))))((
+                        lambda clamped_pixel_index: (  # -> (A,R,G,B)
+                            layer.pixel_alpha_colors[int(clamped_pixel_index)]
+                                if
+                                    clamped_pixel_index == int(clamped_pixel_index)
+                                else
+                            tuple((1.0 - (clamped_pixel_index - int(clamped_pixel_index))) * channel_left +
+                                         (clamped_pixel_index - int(clamped_pixel_index))  * channel_right
+                                for
+                                    channel_left,
+                                    channel_right
+                                in zip(
+                                    layer.pixel_alpha_colors[int(clamped_pixel_index)],
+                                    layer.pixel_alpha_colors[int(clamped_pixel_index)+1]))))(
+                        max(0.0,
+                        min(len(layer.pixel_alpha_colors)-1.0,
+                        pixel_index - layer.pixel_offset)))),
+                    layers,
+                    base_color))
+
+
+    def compose_table(self, layers, base_color, pixel_start, pixel_stop):
+
+        pixel_channels = [[float(channel)] * (pixel_stop - pixel_start) for channel in base_color]
+
+        for layer in layers:
+            pixel_alphas = [pixel_alpha / 65535.0 for pixel_alpha in layer.sample_pixel_alpha_table(pixel_start, pixel_stop)]
+
+            pixel_channels = [
+                [(1.0 - pixel_alpha) * pixel_channel + pixel_alpha * layer_channel
+                    for pixel_alpha, pixel_channel
+                    in zip(pixel_alphas, pixel_channels[channel_index])]
+                for channel_index, layer_channel
+                in enumerate(layer.pixel_color)]
+
+        channels = [0.0] * ((pixel_stop - pixel_start) * 3)
+        for channel_index in xrange(3):
+            channels[channel_index::3] = pixel_channels[channel_index]
+
+        return self.encode_channels(channels)
+
+
+
+class NumpyCompositor(object):
+
+    name = 'numpy'
+
+
+    def __init__(self, table_sampling = False, high_precision = False):
+
+        import numpy
+
+        self.numpy = numpy
+        self.table_sampling = table_sampling
+
+        # same frame layout as the python compositor
+        self.high_precision = high_precision
+        self.channel_size = (2 if high_precision else 1)
+
+
+    def encode_pixel_colors(self, pixel_colors):
+
+        numpy = self.numpy
+
+        if self.high_precision:
+            return bytearray((pixel_colors * 257.0).astype(numpy.uint16).tostring())
+
+        return bytearray(pixel_colors.astype(numpy.int64).astype(numpy.uint8).tostring())
+
+
+    def layer_table(self, layer):
+
+        # (A,R,G,B) rows with the last row repeated, so that interpolation
+        # at the right end can read one row past it with a weight of zero
+        if layer.compositor_data is None:
+            layer.compositor_data = self.numpy.array(
+                layer.pixel_alpha_colors + layer.pixel_alpha_colors[-1:],
+                dtype = self.numpy.float64)
+
+        return layer.compositor_data
+
+
+    def compose(self, layers, base_color, pixel_start, pixel_stop):
+
+        if self.table_sampling:
+            return self.compose_table(layers, base_color, pixel_start, pixel_stop)
+
+        numpy = self.numpy
+
+        pixel_colors = numpy.empty((pixel_stop - pixel_start, len(base_color)), dtype = numpy.float64)
+        pixel_colors[:] = base_color
+
+        if layers:
+            layer_tables = [self.layer_table(layer) for layer in layers]
+
+            layer_table_lengths = numpy.array([len(layer_table) for layer_table in layer_tables])
+            layer_table_starts  = numpy.cumsum(layer_table_lengths) - layer_table_lengths
+            layer_offsets       = numpy.array([layer.pixel_offset for layer in layers])
+
+            # sample all layers at once; same operations in the same order as
+            # the python compositor, so that the results are bit for bit equal
+            clamped_pixel_indices = numpy.clip(
+                numpy.arange(pixel_start, pixel_stop, dtype = numpy.float64)[numpy.newaxis, :] - layer_offsets[:, numpy.newaxis],
+                0.0,
+                (layer_table_lengths - 2.0)[:, numpy.newaxis])
+
+            pixel_indices_left = clamped_pixel_indices.astype(numpy.intp)
+            pixel_fractions    = (clamped_pixel_indices - pixel_indices_left)[:, :, numpy.newaxis]
+
+            table_indices_left = pixel_indices_left + layer_table_starts[:, numpy.newaxis]
+
+            table = numpy.concatenate(layer_tables)
+            layer_pixel_alpha_colors = (
+                (1.0 - pixel_fractions) * table[table_indices_left] +
+                       pixel_fractions  * table[table_indices_left + 1])
+
+            for layer_index in xrange(len(layers)):
+                layer_pixel_alphas = layer_pixel_alpha_colors[layer_index, :, 0:1]
+                layer_pixel_colors = layer_pixel_alpha_colors[layer_index, :, 1:]
+
+                pixel_colors = (1.0 - layer_pixel_alphas) * pixel_colors + layer_pixel_alphas * layer_pixel_colors
+
+        return self.encode_pixel_colors(pixel_colors)
+
+
+    def compose_table(self, layers, base_color, pixel_start, pixel_stop):
+
+        numpy = self.numpy
+
+        pixel_colors = numpy.empty((pixel_stop - pixel_start, len(base_color)), dtype = numpy.float64)
+        pixel_colors[:] = base_color
+
+        if layers:
+            # zero-copy views of the tables shared between layers
+            layer_alpha_tables = [layer.pixel_alpha_table() for layer in layers]
+            layer_tables = [numpy.frombuffer(table, dtype = numpy.uint16) for table_oversampling, table in layer_alpha_tables]
+
+            layer_table_lengths = numpy.array([len(layer_table) for layer_table in layer_tables])
+            layer_table_starts  = numpy.cumsum(layer_table_lengths) - layer_table_lengths
+            layer_oversampling  = numpy.array([table_oversampling for table_oversampling, table in layer_alpha_tables])
+            layer_table_shifts  = numpy.array([layer.pixel_alpha_table_shift() for layer in layers])
+            layer_colors        = numpy.array([layer.pixel_color for layer in layers], dtype = numpy.float64)
+
+            table_indices = numpy.clip(
+                numpy.arange(pixel_start, pixel_stop, dtype = numpy.intp)[numpy.newaxis, :] * layer_oversampling[:, numpy.newaxis] + layer_table_shifts[:, numpy.newaxis],
+                0,
+                (layer_table_lengths - 1)[:, numpy.newaxis])
+
+            table = numpy.concatenate(layer_tables)
+            layer_pixel_alphas = table[table_indices + layer_table_starts[:, numpy.newaxis]] / 65535.0
+
+            for layer_index in xrange(len(layers)):
+                pixel_alphas = layer_pixel_alphas[layer_index, :, numpy.newaxis]
+                pixel_colors = (1.0 - pixel_alphas) * pixel_colors + pixel_alphas * layer_colors[layer_index]
+
+        return self.encode_pixel_colors(pixel_colors)
+
+
+
+def create_compositor(compositor_name = 'auto', table_sampling = False, high_precision = False):
+
+    if compositor_name in ('auto', 'numpy'):
+        try:
+            return NumpyCompositor(table_sampling, high_precision)
+        except ImportError:
+            if compositor_name == 'numpy':
+                raise
+
+    return PythonCompositor(table_sampling, high_precision)
+
+
+
+class PythonColorCorrection(object):
+
+    # takes high precision frames down to the 8 bit channels the light shows,
+    # through gamma and white balance tables per channel; optionally dithers
+    # over time, carrying what each pixel channel fell short of into the next
+    # frame, so that dim colors average out between two output levels
+
+    name = 'python'
+
+    # composited channels are looked up by their top bits
+    table_bits = 12
+
+
+    def __init__(self, strip_size, gamma = 1.0, white_balance = (1.0, 1.0, 1.0), dithering = False):
+
+        self.strip_size = strip_size
+        self.dithering = dithering
+
+        self.table_shift = 16 - self.table_bits
+        table_index_max = float((1 << self.table_bits) - 1)
+
+        # output levels in 8.8 fixed point, the fraction being what dithering carries
+        self.channel_tables = [
+            [min(255 << 8, int(round((255 << 8) * channel_balance * (table_index / table_index_max) ** gamma)))
+                for table_index in xrange(1 << self.table_bits)]
+            for channel_balance in white_balance]
+
+        # rounded to whole output levels, for frames shown without dithering
+        self.channel_tables_rounded = [[(channel + 128) >> 8 for channel in channel_table] for channel_table in self.channel_tables]
+
+        # preallocated per pixel channel; residual is set while any of them falls
+        # between two output levels, and the frame needs showing again to dither
+        self.channel_errors = array.array('H', [0]) * (strip_size * 3)
+        self.frame = bytearray(strip_size * 3)
+        self.residual = False
+
+
+    def correct_frame(self, frame):
+
+        # -> self.frame, overwritten by the next call
+        channels = array.array('H', str(frame))
+
+        residual = False
+
+        for channel_index in xrange(3):
+            table_shift = self.table_shift
+
+            if not self.dithering:
+                channel_table = self.channel_tables_rounded[channel_index]
+                self.frame[channel_index::3] = bytearray([channel_table[channel >> table_shift] for channel in channels[channel_index::3]])
+                continue
+
+            channel_table = self.channel_tables[channel_index]
+            channel_levels = [channel_table[channel >> table_shift] for channel in channels[channel_index::3]]
+
+            dithered_levels = [channel_level + channel_error for channel_level, channel_error in zip(channel_levels, self.channel_errors[channel_index::3])]
+
+            self.frame[channel_index::3] = bytearray([dithered_level >> 8 for dithered_level in dithered_levels])
+            self.channel_errors[channel_index::3] = array.array('H', [dithered_level & 255 for dithered_level in dithered_levels])
+
+            residual = residual or any(channel_level & 255 for channel_level in channel_levels)
+
+        self.residual = residual
+
+        return self.frame
+
+
+
+class NumpyColorCorrection(PythonColorCorrection):
+
+    # same tables and results as the python color correction; every array is
+    # preallocated, so that correcting a frame never allocates
+
+    name = 'numpy'
+
+
+    def __init__(self, strip_size, gamma = 1.0, white_balance = (1.0, 1.0, 1.0), dithering = False):
+
+        import numpy
+
+        PythonColorCorrection.__init__(self, strip_size, gamma, white_balance, dithering)
+
+        self.numpy = numpy
+
+        # tables back to back; each pixel channel adds the start of its own
+        self.channel_table         = numpy.array(self.channel_tables,         dtype = numpy.uint16).ravel()
+        self.channel_table_rounded = numpy.array(self.channel_tables_rounded, dtype = numpy.uint8).ravel()
+        self.channel_table_starts  = numpy.tile(numpy.arange(3, dtype = numpy.intp) << self.table_bits, strip_size)
+
+        self.table_indices     = numpy.empty(strip_size * 3, dtype = numpy.intp)
+        self.channel_levels    = numpy.empty(strip_size * 3, dtype = numpy.uint16)
+        self.channel_fractions = numpy.empty(strip_size * 3, dtype = numpy.uint16)
+        self.error_array       = numpy.zeros(strip_size * 3, dtype = numpy.uint16)
+        self.frame_array       = numpy.empty(strip_size * 3, dtype = numpy.uint8)
+
+
+    def correct_frame(self, frame):
+
+        numpy = self.numpy
+
+        numpy.right_shift(numpy.frombuffer(frame, dtype = numpy.uint16), self.table_shift, out = self.table_indices)
+        numpy.add(self.table_indices, self.channel_table_starts, out = self.table_indices)
+
+        if not self.dithering:
+            numpy.take(self.channel_table_rounded, self.table_indices, out = self.frame_array)
+
+        else:
+            numpy.take(self.channel_table, self.table_indices, out = self.channel_levels)
+
+            numpy.bitwise_and(self.channel_levels, 255, out = self.channel_fractions)
+            self.residual = bool(self.channel_fractions.any())
+
+            numpy.add(self.channel_levels, self.error_array, out = self.channel_levels)
+            numpy.right_shift(self.channel_levels, 8, out = self.frame_array, casting = 'unsafe')
+            numpy.bitwise_and(self.channel_levels, 255, out = self.error_array)
+
+        self.frame[:] = self.frame_array.tostring()
+
+        return self.frame
+
+
+
+def create_color_correction(compositor_name, strip_size, gamma = 1.0, white_balance = (1.0, 1.0, 1.0), dithering = False):
+
+    # numpy whenever the compositor would be numpy
+    if compositor_name in ('auto', 'numpy'):
+        try:
+            return NumpyColorCorrection(strip_size, gamma, white_balance, dithering)
+        except ImportError:
+            if compositor_name == 'numpy':
+                raise
+
+    return PythonColorCorrection(strip_size, gamma, white_balance, dithering)
+
+
+
+def create_monotonic_clock():
+
+    # python 2 has no time.monotonic; ask the c library for CLOCK_MONOTONIC
+    # and fall back to wall-clock time where that is not available
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno = True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        CLOCK_MONOTONIC = 1
+
+        def monotonic_time():
+            # one timespec per call, as the clock is read from several threads
+            clock_timespec = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(clock_timespec)) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            return clock_timespec.tv_sec + clock_timespec.tv_nsec * 1e-9
+
+        monotonic_time()
+
+        return monotonic_time
+
+    except (ImportError, AttributeError, OSError, TypeError):
+        return time.time
+
+
+monotonic_clock = None
+
+
+def monotonic_time():
+
+    # resolved on the first call rather than on import, as finding the c
+    # library may start a subprocess; a race only resolves it twice
+    global monotonic_clock
+
+    if monotonic_clock is None:
+        monotonic_clock = create_monotonic_clock()
+
+    return monotonic_clock()
+
+
+
+class VirtualClock(object):
+
+    # stands in for time.time when rendering on simulated time
+
+    def __init__(self, start_time = 0.0):
+
+        self.current_time = start_time
+
+
+    def __call__(self):
+
+        return self.current_time
+
+
+    def advance(self, delta_time):
+
+        self.current_time += delta_time
+
+
+
+class Metrics(object):
+
+    class Histogram(object):
+
+        # cumulative since start, in seconds; buckets are counted in place
+        bucket_bounds = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+        def __init__(self):
+
+            self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+            self.duration_sum = 0.0
+            self.duration_count = 0
+
+
+        def observe(self, duration):
+
+            self.bucket_counts[bisect.bisect_left(self.bucket_bounds, duration)] += 1
+            self.duration_sum += duration
+            self.duration_count += 1
+
+
+
+    stage_names = ('commands', 'advance', 'compose', 'correct', 'set_frame', 'show', 'sleep_overshoot')
+    route_names = ('/light', '/light/<zone>', '/light/events', '/light/batch', '/metrics', 'web', 'unknown')
+
+    def __init__(self, enabled = False):
+
+        self.enabled = enabled
+
+        # preallocated, so that observing never allocates
+        self.stage_histograms = collections.OrderedDict((stage_name, self.Histogram()) for stage_name in self.stage_names)
+        self.route_histograms = collections.OrderedDict((route_name, self.Histogram()) for route_name in self.route_names)
+
+        # request handlers may run on several threads, and so may the render
+        # threads of zones sharing these metrics
+        self.route_histograms_lock = threading.Lock()
+        self.stage_histograms_lock = threading.Lock()
+
+
+    def observe_stage(self, stage_name, stage_start_time):
+
+        stage_stop_time = time.time()
+        stage_histogram = self.stage_histograms[stage_name]
+
+        self.stage_histograms_lock.acquire()
+        stage_histogram.observe(stage_stop_time - stage_start_time)
+        self.stage_histograms_lock.release()
+
+        # lets stages be timed back to back
+        return stage_stop_time
+
+
+    def observe_route(self, route_name, request_start_time):
+
+        route_histogram = self.route_histograms.get(route_name, self.route_histograms['unknown'])
+
+        self.route_histograms_lock.acquire()
+        route_histogram.observe(time.time() - request_start_time)
+        self.route_histograms_lock.release()
+
+
+    def format_text(self, metric_values, stages_observed = True):
+
+        # prometheus text exposition format; metric_values maps name to (type, help, value),
+        # where value may also map zone names to one value each
+        lines = []
+
+        for metric_name, (metric_type, metric_help, metric_value) in metric_values.items():
+            lines += ['# HELP ambientlight_%s %s' % (metric_name, metric_help)]
+            lines += ['# TYPE ambientlight_%s %s' % (metric_name, metric_type)]
+
+            if isinstance(metric_value, dict):
+                lines += ['ambientlight_%s{zone="%s"} %s' % (metric_name, zone_name, repr(zone_metric_value)) for zone_name, zone_metric_value in metric_value.items()]
+            else:
+                lines += ['ambientlight_%s %s' % (metric_name, repr(metric_value))]
+
+        if stages_observed:
+            lines += self.format_histograms('stage_seconds',    'Frame time spent per render stage, over all zones.', 'stage', self.stage_histograms)
+        lines += self.format_histograms('http_request_seconds', 'HTTP request handling time per route.', 'route', self.route_histograms)
+
+        return '\n'.join(lines) + '\n'
+
+
+    def format_histograms(self, metric_name, metric_help, label_name, histograms):
+
+        lines = [
+            '# HELP ambientlight_%s %s' % (metric_name, metric_help),
+            '# TYPE ambientlight_%s histogram' % metric_name]
+
+        for label_value, histogram in histograms.items():
+            cumulative_count = 0
+            for bucket_bound, bucket_count in zip(histogram.bucket_bounds + (float('inf'),), histogram.bucket_counts):
+                cumulative_count += bucket_count
+                lines += ['ambientlight_%s_bucket{%s="%s",le="%s"} %d' % (metric_name, label_name, label_value, ('+Inf' if bucket_bound == float('inf') else repr(bucket_bound)), cumulative_count)]
+
+            lines += ['ambientlight_%s_sum{%s="%s"} %r' % (metric_name, label_name, label_value, histogram.duration_sum)]
+            lines += ['ambientlight_%s_count{%s="%s"} %d' % (metric_name, label_name, label_value, histogram.duration_count)]
+
+        return lines
+
+
+
+class LightController(object):
+
+    class Layer(object):
+
+        # alpha ramps are tabulated as 16-bit fixed point at sub-pixel steps;
+        # tables are shared between layers and only the most recent are kept
+        table_oversampling = 256
+        table_size_max     = 65536
+        table_cache        = collections.OrderedDict()
+        table_cache_size   = 16
+        table_cache_lock   = threading.Lock()
+
+
+        def __init__(self, pixel_length, pixel_color, pixel_alpha_left, pixel_alpha_right, pixel_offset, pixel_offset_speed):
+
+            self.pixel_offset       = pixel_offset
+            self.pixel_offset_speed = pixel_offset_speed
+            self.pixel_offset_start = pixel_offset
+
+            # compositor-specific representation, built on first use
+            self.compositor_data = None
+
+            if pixel_length == 1:
+                self.pixel_alpha_colors = [
+                    (pixel_alpha_left if pixel_offset_speed > 0.0 else pixel_alpha_right,) + pixel_color]
+
+            else:
+                pixel_alpha_gradient = (pixel_alpha_right - pixel_alpha_left) / (pixel_length - 1)
+
+                self.pixel_alpha_colors = [
+                    (pixel_alpha_left + pixel_alpha_gradient * pixel_index,) + pixel_color
+                        for pixel_index
+                        in xrange(pixel_length)]
+
+            self.pixel_color = pixel_color
+
+            # (oversampling, table), only built once table sampling asks for it
+            self.pixel_alpha_table_entry = None
+
+
+        def set_pixel_color(self, pixel_color):
+
+            # same alpha ramp and position, different color
+            self.pixel_color = pixel_color
+            self.pixel_alpha_colors = [(pixel_alpha_color[0],) + pixel_color for pixel_alpha_color in self.pixel_alpha_colors]
+            self.compositor_data = None
+
+
+        @classmethod
+        def get_pixel_alpha_table(cls, pixel_length, pixel_alpha_left, pixel_alpha_right):
+
+            table_key = (pixel_length, pixel_alpha_left, pixel_alpha_right)
+
+            cls.table_cache_lock.acquire()
+
+            try:
+                table_entry = cls.table_cache.pop(table_key)
+
+            except KeyError:
+                if pixel_length == 1:
+                    table_oversampling = cls.table_oversampling
+                    table = array.array('H', [int(pixel_alpha_left * 65535.0 + 0.5)])
+
+                else:
+                    table_oversampling = max(1, min(cls.table_oversampling, (cls.table_size_max - 1) // (pixel_length - 1)))
+                    table_length = (pixel_length - 1) * table_oversampling + 1
+
+                    table_alpha_gradient = (pixel_alpha_right - pixel_alpha_left) / (table_length - 1)
+
+                    table = array.array('H', [
+                        int((pixel_alpha_left + table_alpha_gradient * table_index) * 65535.0 + 0.5)
+                            for table_index
+                            in xrange(table_length)])
+
+                table_entry = (table_oversampling, table)
+
+                while len(cls.table_cache) >= cls.table_cache_size:
+                    cls.table_cache.popitem(last = False)
+
+            # most recently used entries are kept at the end
+            cls.table_cache[table_key] = table_entry
+
+            cls.table_cache_lock.release()
+
+            return table_entry
+
+
+        def pixel_alpha_table(self):
+
+            # -> (oversampling, table) for this layer's alpha ramp
+            if self.pixel_alpha_table_entry is None:
+                self.pixel_alpha_table_entry = self.get_pixel_alpha_table(
+                    len(self.pixel_alpha_colors),
+                    self.pixel_alpha_colors[ 0][0],
+                    self.pixel_alpha_colors[-1][0])
+
+            return self.pixel_alpha_table_entry
+
+
+        def pixel_alpha_table_shift(self):
+
+            # table index of pixel 0, rounded to the nearest table entry
+            table_oversampling, table = self.pixel_alpha_table()
+
+            return int(math.floor(-self.pixel_offset * table_oversampling + 0.5))
+
+
+        def sample_pixel_alpha_table(self, pixel_start, pixel_stop):
+
+            table_oversampling, table = self.pixel_alpha_table()
+            table_shift = self.pixel_alpha_table_shift()
+            table_index_last = len(table) - 1
+
+            # pixels before and after the table take its end values, those in between
+            # sample it at regular intervals
+            pixel_index_first = min(pixel_stop, max(pixel_start, (-table_shift) // table_oversampling + 1))
+            pixel_index_stop  = min(pixel_stop, max(pixel_index_first, -((table_shift - table_index_last) // table_oversampling)))
+
+            return (
+                [table[0]] * (pixel_index_first - pixel_start) +
+                table[pixel_index_first * table_oversampling + table_shift : pixel_index_stop * table_oversampling + table_shift : table_oversampling].tolist() +
+                [table[table_index_last]] * (pixel_stop - pixel_index_stop))
+
+
+        def opaque_pixel_stop_left(self, pixel_count):
+
+            # pixels clamped to the left end of the layer: pixel_index - pixel_offset <= 0.0
+            if self.pixel_alpha_colors[0][0] != 1.0:
+                return 0
+
+            pixel_offset = self.pixel_offset
+
+            pixel_stop = min(pixel_count, max(0, int(math.floor(pixel_offset)) + 1))
+            while pixel_stop > 0 and not pixel_stop - 1 - pixel_offset <= 0.0:
+                pixel_stop -= 1
+            while pixel_stop < pixel_count and pixel_stop - pixel_offset <= 0.0:
+                pixel_stop += 1
+
+            return pixel_stop
+
+
+        def opaque_pixel_start_right(self, pixel_count):
+
+            # pixels clamped to the right end of the layer: pixel_index - pixel_offset >= pixel_length - 1.0
+            if self.pixel_alpha_colors[-1][0] != 1.0:
+                return pixel_count
+
+            pixel_offset = self.pixel_offset
+            pixel_index_last = len(self.pixel_alpha_colors) - 1.0
+
+            pixel_start = min(pixel_count, max(0, int(math.ceil(pixel_offset + pixel_index_last))))
+            while pixel_start > 0 and pixel_start - 1 - pixel_offset >= pixel_index_last:
+                pixel_start -= 1
+            while pixel_start < pixel_count and not pixel_start - pixel_offset >= pixel_index_last:
+                pixel_start += 1
+
+            return pixel_start
+
+
+        def opaque_pixel_spans(self, pixel_count):
+
+            # the compositors produce exactly the layer color where it is clamped
+            # to an end with an alpha of 1.0, regardless of what is below
+            opaque_pixel_spans = []
+
+            pixel_stop = self.opaque_pixel_stop_left(pixel_count)
+            if pixel_stop > 0:
+                opaque_pixel_spans += [(0, pixel_stop)]
+
+            pixel_start = self.opaque_pixel_start_right(pixel_count)
+            if pixel_start < pixel_count:
+                opaque_pixel_spans += [(pixel_start, pixel_count)]
+
+            return opaque_pixel_spans
+
+
+        def passed_pixels(self, pixel_count):
+
+            if self.pixel_offset_speed < 0.0:
+                # moves right to left, gone once its right-hand end has left on the left-hand side
+                return not self.pixel_offset + len(self.pixel_alpha_colors) > 0.0
+            else:
+                # moves left to right, gone once its left-hand end has left on the right-hand side
+                return not self.pixel_offset < pixel_count
+
+
+        def passed_pixel_color(self):
+
+            # what the layer leaves behind: the color at its trailing end
+            if self.pixel_offset_speed < 0.0:
+                return self.pixel_alpha_colors[-1][1:]
+            else:
+                return self.pixel_alpha_colors[0][1:]
+
+
+        def covers_pixels_for_good(self, pixel_count):
+
+            # opaque ends only ever cover more pixels while the layer moves towards them
+            if len(self.pixel_alpha_colors) == 1:
+                return self.pixel_alpha_colors[0][0] == 1.0
+
+            if self.pixel_offset_speed >= 0.0 and self.opaque_pixel_stop_left(pixel_count) == pixel_count:
+                return True
+
+            if self.pixel_offset_speed <= 0.0 and self.opaque_pixel_start_right(pixel_count) == 0:
+                return True
+
+            return False
+
+
+
+    class Timeline(object):
+
+        # frames of a lone transition, one per step, compiled a few at a time
+        # by the render thread until the layer's travel is complete
+
+        def __init__(self, layer, timeline_key, pixel_offset_step, timeline_frames = None):
+
+            self.layer = layer
+            self.timeline_key = timeline_key
+            self.pixel_offset_step = pixel_offset_step
+
+            # base color the layer was pushed over, as keyed
+            self.layer_base_color = timeline_key[0]
+
+            self.complete = (timeline_frames is not None)
+            self.frames = timeline_frames if self.complete else bytearray()
+            self.frame_count = 0
+
+            # replays the layer's travel, at the offset of the next frame to compile
+            self.compile_layer = copy.copy(layer)
+
+
+
+    def __init__(self, light, step_rate = 0.0, compositor = None, partial_updates = False, event_stream = None, progress_rate = 0.0, coalesce_window = 0.0, clock = monotonic_time, metrics = None, adaptive_step_rate = False, min_step_rate = 15, layer_command_connection = None, precompile_transitions = False, color_correction = None):
+
+        self.light = light
+        self.clock = clock
+        self.compositor = compositor or PythonCompositor()
+
+        # bytes per composited pixel; a color correction takes high precision
+        # frames down to 8 bit channels on their way to the light
+        self.pixel_size = 3 * self.compositor.channel_size
+        self.color_correction = color_correction
+        self.light_color = (0,0,0)
+        self.light_color_history = [self.light_color]
+        self.light_color_history_length = 16
+
+        self.step_rate = step_rate
+
+        # lowered under load and raised back with headroom, when adaptive
+        self.adaptive_step_rate = adaptive_step_rate
+        self.min_step_rate = min(min_step_rate, step_rate)
+        self.step_rate_current = step_rate
+        self.step_rate_achieved = 0.0
+        self.step_window_closed = False
+
+        # writers never touch the layers; they queue commands that the render
+        # thread applies at the start of its next frame
+        self.light_color_lock = threading.RLock()
+        self.layer_commands = collections.deque()
+        self.layer_command_batch = None
+        self.layer_command_connection = layer_command_connection
+
+        self.layers = []
+        self.layer_base_color = self.light_color
+        self.layer_thread = None
+        self.layer_thread_idle = False
+        self.layer_thread_running = False
+
+        self.layer_condition_wait_step = threading.Condition()
+
+        # transitions arriving in quick succession retarget the newest layer
+        self.coalesce_window = coalesce_window
+        self.coalesce_layer = None
+        self.coalesce_layer_time = None
+        self.coalesce_transition_time = None
+
+        self.event_stream = event_stream
+        self.progress_rate = progress_rate
+        self.prev_progress_time = None
+
+        self.metrics = metrics
+
+        # a lone transition is compiled frame by frame for the target step
+        # rate, a few frames per step, and played back as long as nothing
+        # interrupts it; until compiling has caught up, frames are composited
+        self.precompile_transitions = precompile_transitions
+        self.timeline = None
+        self.timeline_compile_frames = 3
+        self.timeline_cache = collections.OrderedDict()
+        self.timeline_cache_size = 8
+        self.timeline_size_max = 4 * 1024 * 1024
+
+        self.partial_updates = partial_updates
+        self.last_frame = None
+        self.frames_shown = 0
+        self.frames_skipped = 0
+        self.frames_missed = 0
+        self.frames_played = 0
+
+
+    def start(self):
+
+        if not self.layer_thread:
+            self.layer_base_color = self.light_color
+
+            self.layer_thread_running = True
+            self.layer_thread = threading.Thread(target = self.layer_thread_proc)
+            self.layer_thread.start()
+
+
+    def stop(self):
+
+        if self.layer_thread:
+            self.layer_thread_running = False
+
+            self.layer_condition_wait_step.acquire()
+            self.layer_condition_wait_step.notify()
+            self.layer_condition_wait_step.release()
+
+            self.layer_thread.join()
+            self.layer_thread = None
+
+
+    def layer_thread_proc(self):
+
+        self.start_render_steps()
+
+        while self.layer_thread_running:
+            step_wait_duration = self.render_step()
+
+            if not self.layer_thread_running:
+                break
+
+            self.layer_condition_wait_step.acquire()
+
+            if step_wait_duration is not None:
+                # sleep until the next deadline
+                if step_wait_duration > 0.0:
+                    self.layer_condition_wait_step.wait(step_wait_duration)
+
+            elif not self.layer_commands and self.layer_thread_running:
+                # sleep until awakened, unless commands arrived in the meantime
+                self.layer_thread_idle = True
+                self.layer_condition_wait_step.wait()
+                self.layer_thread_idle = False
+
+            self.layer_condition_wait_step.release()
+
+
+    def start_render_steps(self):
+
+        # pixels as composited; a MappedLight lays them out on the strip
+        self.step_frame = bytearray(self.light.strip_size * self.pixel_size)
+
+        self.reset_step_timing()
+
+
+    def reset_step_timing(self):
+
+        self.prev_step_time = self.clock()
+        self.next_step_deadline = self.prev_step_time
+        self.step_wake_time = None
+        self.step_idle = False
+        self.reset_step_window(self.prev_step_time)
+
+
+    def render_step(self):
+
+        # applies commands and shows a frame if there are layers; returns how long
+        # until the next step is due, or None when idle until commands arrive; the
+        # caller does the waiting, on a condition or in an event loop
+        if self.step_idle:
+            # restart step timing (otherwise next step delta includes sleep)
+            self.reset_step_timing()
+
+        step_start_time = self.clock()
+
+        metrics = self.active_metrics()
+
+        if metrics and self.step_wake_time is not None:
+            metrics.observe_stage('sleep_overshoot', min(time.time(), self.step_wake_time))
+        self.step_wake_time = None
+
+        if metrics: stage_start_time = time.time()
+
+        self.apply_layer_commands()
+
+        if metrics: metrics.observe_stage('commands', stage_start_time)
+
+        if self.layers:
+            curr_step_time = self.clock()
+            delta_step_time = curr_step_time - self.prev_step_time
+            self.prev_step_time = curr_step_time
+
+            self.render_layers(curr_step_time, delta_step_time, self.step_frame, self.light.strip_size)
+            self.show_frame(self.step_frame)
+
+        elif self.color_correction and self.color_correction.residual:
+            # nothing moves, but dithering has fractions left to show
+            self.prev_step_time = self.clock()
+            self.show_frame(self.step_frame)
+
+        if not self.layers and not (self.color_correction and self.color_correction.residual):
+            self.step_idle = True
+            return None
+
+        step_duration = (1.0 / self.step_rate_current if self.step_rate_current > 0.0 else 0.0)
+
+        step_done_time = self.clock()
+        self.account_step(step_start_time, step_done_time)
+
+        if step_duration <= 0.0:
+            return 0.0
+
+        # absolute deadlines, so that errors do not accumulate
+        self.next_step_deadline += step_duration
+
+        if step_done_time > self.next_step_deadline:
+            # behind: drop the steps whose deadlines have passed rather than
+            # rushing to catch up; layers still advance by the time elapsed
+            missed_step_count = int((step_done_time - self.next_step_deadline) / step_duration) + 1
+            self.next_step_deadline += missed_step_count * step_duration
+            self.frames_missed += missed_step_count
+
+        step_wait_duration = self.next_step_deadline - step_done_time
+
+        if metrics: self.step_wake_time = time.time() + step_wait_duration
+
+        return step_wait_duration
+
+
+    def reset_step_window(self, step_window_start_time):
+
+        self.step_window_start_time = step_window_start_time
+        self.step_window_frame_count = 0
+        self.step_window_busy_duration = 0.0
+        self.step_window_frames_missed = self.frames_missed
+
+
+    def account_step(self, step_start_time, step_done_time):
+
+        # evaluated once per second spent rendering
+        self.step_window_frame_count += 1
+        self.step_window_busy_duration += step_done_time - step_start_time
+
+        if self.step_window_frame_count == 1:
+            self.step_window_first_done_time = step_done_time
+
+        step_window_duration = step_done_time - self.step_window_start_time
+        if step_window_duration < 1.0:
+            # until a full window has closed, the rate between the frames of
+            # the partial one is the best there is
+            if not self.step_window_closed and step_done_time > self.step_window_first_done_time:
+                self.step_rate_achieved = (self.step_window_frame_count - 1) / (step_done_time - self.step_window_first_done_time)
+            return
+
+        self.step_rate_achieved = self.step_window_frame_count / step_window_duration
+        self.step_window_closed = True
+
+        if self.adaptive_step_rate and self.step_rate > 0.0:
+            busy_fraction = self.step_window_busy_duration / step_window_duration
+
+            if self.frames_missed > self.step_window_frames_missed or busy_fraction > 0.8:
+                # back off before frames get dropped
+                self.step_rate_current = max(self.min_step_rate, self.step_rate_current * 0.8)
+            elif busy_fraction < 0.5:
+                # headroom for the next step up, even at the higher rate
+                self.step_rate_current = min(self.step_rate, self.step_rate_current * 1.25)
+
+        self.reset_step_window(step_done_time)
+
+
+    def render_steps(self, step_duration, step_count = None):
+
+        # composites frames back to back on simulated time, without sleeping,
+        # until the layers are done or step_count frames have been shown; not
+        # to be mixed with the layer thread
+
+        # pixels as composited; a MappedLight lays them out on the strip
+        pixel_count = self.light.strip_size
+
+        frame = bytearray(pixel_count * self.pixel_size)
+
+        step_index = 0
+
+        while (self.layers or self.layer_commands) and (step_count is None or step_index < step_count):
+            if isinstance(self.clock, VirtualClock):
+                self.clock.advance(step_duration)
+
+            self.apply_layer_commands()
+
+            self.render_layers(self.clock(), step_duration, frame, pixel_count)
+            self.show_frame(frame)
+
+            step_index += 1
+
+        return step_index
+
+
+    def render_layers(self, curr_step_time, delta_step_time, frame, pixel_count):
+
+        # render thread only
+
+        metrics = self.active_metrics()
+
+        if metrics: stage_start_time = time.time()
+
+        self.advance_layers(delta_step_time, pixel_count)
+
+        if metrics: stage_start_time = metrics.observe_stage('advance', stage_start_time)
+
+        timeline_frame_index = self.timeline_frame_index()
+
+        if timeline_frame_index is not None and not self.timeline.complete:
+            self.compile_timeline(self.timeline, pixel_count, self.timeline_compile_frames)
+
+        if timeline_frame_index is not None and timeline_frame_index < self.timeline.frame_count:
+            frame[:] = self.timeline.frames[timeline_frame_index*len(frame):(timeline_frame_index+1)*len(frame)]
+            self.frames_played += 1
+        else:
+            frame[:] = self.compose_layers(self.layers, self.layer_base_color, pixel_count)
+
+        if metrics: metrics.observe_stage('compose', stage_start_time)
+
+        if self.event_stream and self.progress_rate > 0.0:
+            # capped rate while in flight, but always report completion
+            if not self.layers or self.prev_progress_time is None or curr_step_time - self.prev_progress_time >= 1.0 / self.progress_rate:
+                self.prev_progress_time = curr_step_time
+                self.event_stream.publish('progress', collections.OrderedDict((
+                    ('progress', round(self.transition_progress(pixel_count), 3)),
+                    ('layers',   len(self.layers)),
+                )))
+
+
+    def active_metrics(self):
+
+        return (self.metrics if self.metrics and self.metrics.enabled else None)
+
+
+    def advance_layers(self, delta_step_time, pixel_count):
+
+        for layer in self.layers:
+            layer.pixel_offset += layer.pixel_offset_speed * delta_step_time
+
+        while self.layers and self.layers[0].passed_pixels(pixel_count):
+            self.layer_base_color = self.layers.pop(0).passed_pixel_color()
+
+        # layers below one that covers the whole range for good will never show again
+        for layer_index in xrange(len(self.layers) - 1, 0, -1):
+            layer = self.layers[layer_index]
+            if layer.covers_pixels_for_good(pixel_count):
+                self.layer_base_color = layer.pixel_color
+                del self.layers[:layer_index]
+                break
+
+
+    def compose_layers(self, layers, base_color, pixel_count):
+
+        return bytearray().join(
+            self.compositor.compose(layers[layer_index+1:], layer_base_color, pixel_start, pixel_stop)
+                for layer_index, layer_base_color, pixel_start, pixel_stop
+                in self.visible_layer_spans(layers, base_color, pixel_count))
+
+
+    def visible_layer_spans(self, layers, base_color, pixel_count):
+
+        # topmost opaque layer for each pixel; compositing starts above it
+        pixel_layer_indices = [-1] * pixel_count
+
+        for layer_index, layer in enumerate(layers):
+            for pixel_span_start, pixel_span_stop in layer.opaque_pixel_spans(pixel_count):
+                pixel_layer_indices[pixel_span_start:pixel_span_stop] = [layer_index] * (pixel_span_stop - pixel_span_start)
+
+        pixel_start = 0
+
+        for layer_index, pixel_layer_index_group in itertools.groupby(pixel_layer_indices):
+            pixel_stop = pixel_start + len(list(pixel_layer_index_group))
+
+            if layer_index < 0:
+                yield (layer_index, base_color, pixel_start, pixel_stop)
+            else:
+                yield (layer_index, layers[layer_index].pixel_color, pixel_start, pixel_stop)
+
+            pixel_start = pixel_stop
+
+
+    def show_frame(self, frame):
+
+        last_frame = self.last_frame
+        color_correction = self.color_correction
+
+        if last_frame is not None and frame == last_frame and not (color_correction and color_correction.residual):
+            # rounds to the same bytes as the frame already shown
+            self.frames_skipped += 1
+            self.light.skip_show()
+            return
+
+        metrics = self.active_metrics()
+
+        if metrics: stage_start_time = time.time()
+
+        if color_correction:
+            light_frame = color_correction.correct_frame(frame)
+
+            if metrics: stage_start_time = metrics.observe_stage('correct', stage_start_time)
+        else:
+            light_frame = frame
+
+        self.light.set_frame(light_frame)
+
+        if metrics: stage_start_time = metrics.observe_stage('set_frame', stage_start_time)
+
+        if last_frame is None:
+            self.last_frame = bytearray(frame)
+
+            self.light.show()
+
+        elif self.partial_updates and not (color_correction and color_correction.dithering):
+            # dithered pixels may change anywhere, even in an unchanged frame
+            self.light.show_partial(*changed_pixel_span(frame, last_frame, self.pixel_size))
+
+            last_frame[:] = frame
+
+        else:
+            self.light.show()
+
+            last_frame[:] = frame
+
+        if metrics: metrics.observe_stage('show', stage_start_time)
+
+        self.frames_shown += 1
+
+
+    def set_light_color(self, light_color, transition_time = 0.0):
+
+        # writers only decide and queue; the render thread builds the layers
+        self.light_color_lock.acquire()
+
+        try:
+            if light_color == self.light_color: return
+
+            channel_weights = (0.2989, 0.5870, 0.1140)
+            old_light_color_lightness = sum(channel * channel_weight for channel, channel_weight in zip(self.light_color, channel_weights))
+            new_light_color_lightness = sum(channel * channel_weight for channel, channel_weight in zip(     light_color, channel_weights))
+
+            layer_time = self.clock()
+
+            coalesce = (
+                self.coalesce_window > 0.0 and
+                self.coalesce_layer_time is not None and
+                layer_time - self.coalesce_layer_time < self.coalesce_window and
+                transition_time == self.coalesce_transition_time)
+
+            self.coalesce_layer_time = layer_time
+            self.coalesce_transition_time = transition_time
+
+            self.light_color = light_color
+
+            self.light_color_history += [light_color]
+            self.light_color_history = self.light_color_history[-self.light_color_history_length:]
+
+            # published before the layer is queued, so that it precedes any progress
+            if self.event_stream:
+                self.event_stream.publish('light', self.light_state())
+
+            self.queue_layer_command(('push_layer', (
+                light_color,
+                transition_time,
+                new_light_color_lightness > old_light_color_lightness,
+                coalesce)))
+
+        finally:
+            self.light_color_lock.release()
+
+
+    def apply_batch(self, batch_operations):
+
+        # queued as a single command, the render thread sees either none or all
+        # of the operations
+        self.light_color_lock.acquire()
+
+        self.layer_command_batch = []
+
+        try:
+            for batch_operation in batch_operations:
+                batch_operation()
+        finally:
+            layer_command_batch = self.layer_command_batch
+            self.layer_command_batch = None
+
+            if layer_command_batch:
+                self.queue_layer_command(('run_layer_commands', (layer_command_batch,)))
+
+            self.light_color_lock.release()
+
+
+    def queue_layer_command(self, layer_command):
+
+        # caller holds light_color_lock, which keeps commands in order; commands
+        # are (method name, args), so that they can be sent to another process
+        if self.layer_command_batch is not None:
+            self.layer_command_batch += [layer_command]
+            return
+
+        if self.layer_command_connection:
+            # rendered by another process
+            self.layer_command_connection.send(layer_command)
+            return
+
+        self.layer_commands.append(layer_command)
+
+        # wake the render thread, unless it is sleeping towards its next frame anyway
+        self.layer_condition_wait_step.acquire()
+        if self.layer_thread_idle:
+            self.layer_condition_wait_step.notify()
+        self.layer_condition_wait_step.release()
+
+
+    def apply_layer_commands(self):
+
+        # render thread only; deque operations are atomic, no lock needed
+        layer_commands = self.layer_commands
+
+        while layer_commands:
+            layer_command = layer_commands.popleft()
+            self.run_layer_command(layer_command)
+
+
+    def run_layer_command(self, layer_command):
+
+        command_name, command_args = layer_command
+        getattr(self, command_name)(*command_args)
+
+
+    def run_layer_commands(self, layer_commands):
+
+        for layer_command in layer_commands:
+            self.run_layer_command(layer_command)
+
+
+    def receive_layer_commands(self, layer_command_connection):
+
+        # queues commands sent by the control process until it sends None
+        while True:
+            layer_command = layer_command_connection.recv()
+            if layer_command is None:
+                break
+
+            self.light_color_lock.acquire()
+            self.queue_layer_command(layer_command)
+            self.light_color_lock.release()
+
+
+    def push_layer(self, light_color, transition_time, brighter, coalesce):
+
+        if coalesce and self.layers and self.layers[-1] is self.coalesce_layer:
+            # keep the transition in flight, but aim it at the new color
+            self.coalesce_layer.set_pixel_color(light_color)
+            self.timeline = None
+            return
+
+        if transition_time <= 0.0:
+            # dummy layer that is instantly complete
+            layer = self.Layer(
+                pixel_length       = 1,
+                pixel_color        = light_color,
+                pixel_alpha_left   = 1.0,
+                pixel_alpha_right  = 1.0,
+                pixel_offset       = -1.0,
+                pixel_offset_speed = -1.0)
+
+        else:
+            # pixel 0 is outside and the last pixel in the center, as laid out
+            # by the light's pixel map
+            pixel_count = self.light.strip_size
+
+            if brighter:
+                # fade in brighter colors from center to outside
+                layer = self.Layer(
+                    pixel_length       = pixel_count,
+                    pixel_color        = light_color,
+                    pixel_alpha_left   = 0.0,
+                    pixel_alpha_right  = 1.0,
+                    pixel_offset       = pixel_count,
+                    pixel_offset_speed = -pixel_count / float(transition_time))
+            else:
+                # fade in darker colors from outside to center
+                layer = self.Layer(
+                    pixel_length       = pixel_count,
+                    pixel_color        = light_color,
+                    pixel_alpha_left   = 1.0,
+                    pixel_alpha_right  = 0.0,
+                    pixel_offset       = -pixel_count,
+                    pixel_offset_speed = pixel_count / float(transition_time))
+
+        self.layers += [layer]
+        self.coalesce_layer = layer
+
+        if self.precompile_transitions and len(self.layers) == 1 and transition_time > 0.0 and self.step_rate > 0.0:
+            self.timeline = self.get_timeline(layer, self.light.strip_size)
+        else:
+            self.timeline = None
+
+
+    def get_timeline(self, layer, pixel_count):
+
+        # -> Timeline, complete if cached, or None if too long to keep
+        pixel_offset_step = layer.pixel_offset_speed / self.step_rate
+
+        timeline_key = (
+            self.layer_base_color,
+            layer.pixel_color,
+            layer.pixel_alpha_colors[0][0],
+            layer.pixel_alpha_colors[-1][0],
+            len(layer.pixel_alpha_colors),
+            layer.pixel_offset_start,
+            pixel_offset_step,
+            pixel_count)
+
+        try:
+            timeline_frames = self.timeline_cache.pop(timeline_key)
+
+        except KeyError:
+            if layer.pixel_offset_speed < 0.0:
+                pixel_offset_distance = layer.pixel_offset_start + len(layer.pixel_alpha_colors)
+            else:
+                pixel_offset_distance = pixel_count - layer.pixel_offset_start
+
+            frame_count = int(pixel_offset_distance / abs(pixel_offset_step)) + 2
+
+            if frame_count * pixel_count * self.pixel_size > self.timeline_size_max:
+                return None
+
+            # compiled by the render thread as the transition goes along
+            return self.Timeline(layer, timeline_key, pixel_offset_step)
+
+        # most recently used entries are kept at the end
+        self.timeline_cache[timeline_key] = timeline_frames
+
+        timeline = self.Timeline(layer, timeline_key, pixel_offset_step, timeline_frames)
+        timeline.frame_count = len(timeline_frames) // (pixel_count * self.pixel_size)
+
+        return timeline
+
+
+    def compile_timeline(self, timeline, pixel_count, frame_count):
+
+        # the layer's travel replayed on a copy, up to frame_count frames at a
+        # time, until it has passed; the final frame shows what it leaves
+        # behind, and the complete timeline is kept for the next time around
+        compile_layer = timeline.compile_layer
+
+        # advanced the way advance_layers does with steps on time, so that
+        # played frames match composited ones exactly rather than by rounding
+        delta_step_time = 1.0 / self.step_rate
+
+        for frame_index in xrange(frame_count):
+            if compile_layer.passed_pixels(pixel_count):
+                timeline.frames += self.compose_layers([], compile_layer.passed_pixel_color(), pixel_count)
+                timeline.frame_count += 1
+                timeline.complete = True
+                break
+
+            timeline.frames += self.compose_layers([compile_layer], timeline.layer_base_color, pixel_count)
+            timeline.frame_count += 1
+
+            compile_layer.pixel_offset += compile_layer.pixel_offset_speed * delta_step_time
+
+        # only kept if compiled while its layer was still the lone layer
+        if timeline.complete and len(self.layers) == 1 and self.layers[0] is timeline.layer:
+            while len(self.timeline_cache) >= self.timeline_cache_size:
+                self.timeline_cache.popitem(last = False)
+
+            self.timeline_cache[timeline.timeline_key] = timeline.frames
+
+
+    def timeline_frame_index(self):
+
+        # frame of the timeline nearest to where its layer has got to, which
+        # may not have been compiled yet, or None once another layer has
+        # interrupted it or its layer has been folded into the base color
+        if self.timeline is None:
+            return None
+
+        timeline = self.timeline
+
+        if len(self.layers) != 1 or self.layers[0] is not timeline.layer:
+            self.timeline = None
+            return None
+
+        timeline_frame_index = int(round((timeline.layer.pixel_offset - timeline.layer.pixel_offset_start) / timeline.pixel_offset_step))
+
+        if timeline.complete:
+            return max(0, min(timeline.frame_count - 1, timeline_frame_index))
+
+        return max(0, timeline_frame_index)
+
+
+    def light_state(self):
+
+        light_color = self.light_color
+
+        return collections.OrderedDict((
+            ('r', light_color[0]),
+            ('g', light_color[1]),
+            ('b', light_color[2]),
+        ))
+
+
+    def transition_progress(self, pixel_count):
+
+        if not self.layers:
+            return 1.0
+
+        # newest layer, from where it started to where it will be removed
+        layer = self.layers[-1]
+
+        if layer.pixel_offset_speed < 0.0:
+            pixel_offset_stop = -len(layer.pixel_alpha_colors)
+        else:
+            pixel_offset_stop = pixel_count
+
+        if pixel_offset_stop == layer.pixel_offset_start:
+            return 1.0
+
+        return max(0.0, min(1.0, (layer.pixel_offset - layer.pixel_offset_start) / (pixel_offset_stop - layer.pixel_offset_start)))
+
+
+
+class ZoneRenderLoop(object):
+
+    # steps the light controllers of all zones together, on one thread or in
+    # an event loop like a single controller, and shows their ZoneStrip once
+    # per step rather than once per zone
+
+    def __init__(self, light_controllers, zone_strip):
+
+        self.light_controllers = light_controllers
+        self.zone_strip = zone_strip
+        self.clock = light_controllers[0].clock
+
+        self.layer_thread = None
+        self.layer_thread_running = False
+
+        # commands queued for any zone wake this loop instead of the zone's thread
+        self.layer_condition_wait_step = threading.Condition()
+
+        for light_controller in light_controllers:
+            light_controller.layer_condition_wait_step = self.layer_condition_wait_step
+
+
+    @property
+    def layer_commands(self):
+
+        return any(light_controller.layer_commands for light_controller in self.light_controllers)
+
+
+    def start(self):
+
+        if not self.layer_thread:
+            for light_controller in self.light_controllers:
+                light_controller.layer_base_color = light_controller.light_color
+
+            self.layer_thread_running = True
+            self.layer_thread = threading.Thread(target = self.layer_thread_proc)
+            self.layer_thread.start()
+
+
+    def stop(self):
+
+        if self.layer_thread:
+            self.layer_thread_running = False
+
+            self.layer_condition_wait_step.acquire()
+            self.layer_condition_wait_step.notify()
+            self.layer_condition_wait_step.release()
+
+            self.layer_thread.join()
+            self.layer_thread = None
+
+
+    def layer_thread_proc(self):
+
+        self.start_render_steps()
+
+        while self.layer_thread_running:
+            step_wait_duration = self.render_step()
+
+            if not self.layer_thread_running:
+                break
+
+            self.layer_condition_wait_step.acquire()
+
+            if step_wait_duration is not None:
+                if step_wait_duration > 0.0:
+                    self.layer_condition_wait_step.wait(step_wait_duration)
+
+            elif not self.layer_commands and self.layer_thread_running:
+                self.set_layer_thread_idle(True)
+                self.layer_condition_wait_step.wait()
+                self.set_layer_thread_idle(False)
+
+            self.layer_condition_wait_step.release()
+
+
+    def set_layer_thread_idle(self, layer_thread_idle):
+
+        # caller holds layer_condition_wait_step
+        for light_controller in self.light_controllers:
+            light_controller.layer_thread_idle = layer_thread_idle
+
+
+    def start_render_steps(self):
+
+        for light_controller in self.light_controllers:
+            light_controller.start_render_steps()
+
+
+    def render_step(self):
+
+        # every zone steps, whether or not its own deadline has come, so that
+        # they stay in step; the next step is due when the first zone wants it
+        step_wait_durations = [light_controller.render_step() for light_controller in self.light_controllers]
+
+        self.zone_strip.show()
+
+        step_wait_durations = [step_wait_duration for step_wait_duration in step_wait_durations if step_wait_duration is not None]
+
+        return (min(step_wait_durations) if step_wait_durations else None)
+
+
+
+class LightManager(object):
+
+    def __init__(self, light_controller, cycle_light_colors, cycle_transition_time = 0.0, off_light_color = (0,0,0), off_transition_time = 0.0):
+
+        self.light_controller = light_controller
+
+        self.cycle_light_colors    = cycle_light_colors
+        self.cycle_transition_time = cycle_transition_time
+        self.off_light_color       = off_light_color
+        self.off_transition_time   = off_transition_time
+
+
+    def is_on(self):
+
+        return (self.light_controller.light_color != self.off_light_color)
+
+
+    def is_off(self):
+
+        return (self.light_controller.light_color == self.off_light_color)
+
+
+    def switch_on(self):
+
+        if self.is_off():
+            if len(self.light_controller.light_color_history) < 2:
+                on_light_color = self.cycle_light_colors[0]
+            else:
+                # last history color must be off, previous is most recent on
+                on_light_color = self.light_controller.light_color_history[-2]
+
+            self.light_controller.set_light_color(on_light_color, self.cycle_transition_time)
 
 
     def switch_off(self):
 
-        if self.is_on():
-            self.light_controller.set_light_color(self.off_light_color, self.off_transition_time)
+        if self.is_on():
+            self.light_controller.set_light_color(self.off_light_color, self.off_transition_time)
+
+
+    def cycle(self):
+
+        if self.is_off():
+            self.switch_on()
+        else:
+            try:
+                curr_cycle_light_color_index = self.cycle_light_colors.index(self.light_controller.light_color)
+                next_cycle_light_color = self.cycle_light_colors[(curr_cycle_light_color_index + 1) % len(self.cycle_light_colors)]
+            except:
+                next_cycle_light_color = self.cycle_light_colors[0]
+
+            self.light_controller.set_light_color(next_cycle_light_color, self.cycle_transition_time)
+
+
+
+class LightEventStream(object):
+
+    # server-sent events; a single thread encodes each event once and writes it
+    # to all subscribed connections without ever blocking on one of them
+
+    class Subscriber(object):
+
+        def __init__(self, connection, pending_data):
+
+            self.connection   = connection
+            self.pending_data = pending_data
+
+
+
+    def __init__(self, heartbeat_interval = 15.0, pending_data_max = 65536):
+
+        self.heartbeat_interval = heartbeat_interval
+        self.pending_data_max   = pending_data_max
+
+        self.subscribers = []
+
+        self.queued_subscribers = []
+        self.queued_data = []
+        self.queue_lock = threading.Lock()
+
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        fcntl.fcntl(self.wakeup_write_fd, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.next_heartbeat_time = time.time() + self.heartbeat_interval
+
+        self.stream_thread = None
+        self.stream_thread_running = False
+
+
+    def start(self):
+
+        if not self.stream_thread:
+            self.stream_thread_running = True
+            self.stream_thread = threading.Thread(target = self.stream_thread_proc)
+            self.stream_thread.daemon = True
+            self.stream_thread.start()
+
+
+    def stop(self):
+
+        if self.stream_thread:
+            self.stream_thread_running = False
+            self.wakeup()
+
+            self.stream_thread.join()
+            self.stream_thread = None
+
+
+    def encode_event(self, event_name, event_data):
+
+        return 'event: %s\ndata: %s\n\n' % (event_name, json.dumps(event_data))
+
+
+    def publish(self, event_name, event_data):
+
+        # nothing to encode while nobody listens
+        if not self.subscribers and not self.queued_subscribers:
+            return
+
+        self.queue_lock.acquire()
+        self.queued_data += [self.encode_event(event_name, event_data)]
+        self.queue_lock.release()
+
+        self.wakeup()
+
+
+    def subscribe(self, connection, initial_data = ''):
+
+        connection.setblocking(0)
+
+        self.queue_lock.acquire()
+        self.queued_subscribers += [self.Subscriber(connection, initial_data)]
+        self.queue_lock.release()
+
+        self.wakeup()
+
+
+    def wakeup(self):
+
+        try:
+            os.write(self.wakeup_write_fd, 'x')
+        except OSError as error:
+            # pipe full, stream thread is awake anyway
+            if error.errno != errno.EAGAIN:
+                raise
+
+
+    def drop(self, subscriber):
+
+        self.subscribers.remove(subscriber)
+
+        try:
+            subscriber.connection.close()
+        except socket.error:
+            pass
+
+
+    def drop_all(self):
+
+        self.queue_lock.acquire()
+        self.subscribers += self.queued_subscribers
+        self.queued_subscribers = []
+        self.queue_lock.release()
+
+        for subscriber in list(self.subscribers):
+            self.drop(subscriber)
+
+
+    def stream_thread_proc(self):
+
+        while self.stream_thread_running:
+            read_fds, write_fds, stream_timeout = self.stream_fds()
+
+            readable_fds, writable_fds, error_fds = select.select(read_fds, write_fds, [], stream_timeout)
+
+            self.stream_step(readable_fds, writable_fds)
+
+        self.drop_all()
+
+
+    def stream_fds(self):
+
+        # -> (fds to read from, fds to write to, seconds until the next heartbeat)
+        read_fds  = [self.wakeup_read_fd] + [subscriber.connection for subscriber in self.subscribers]
+        write_fds = [subscriber.connection for subscriber in self.subscribers if subscriber.pending_data]
+
+        return (read_fds, write_fds, max(0.0, self.next_heartbeat_time - time.time()))
+
+
+    def stream_step(self, readable_fds, writable_fds):
+
+        # called from the stream thread, or from an event loop selecting on stream_fds
+        if self.wakeup_read_fd in readable_fds:
+            os.read(self.wakeup_read_fd, 4096)
+
+        self.queue_lock.acquire()
+        self.subscribers += self.queued_subscribers
+        queued_data = ''.join(self.queued_data)
+        self.queued_subscribers = []
+        self.queued_data = []
+        self.queue_lock.release()
+
+        if time.time() >= self.next_heartbeat_time:
+            queued_data += ': heartbeat\n\n'
+            self.next_heartbeat_time = time.time() + self.heartbeat_interval
+
+        for subscriber in list(self.subscribers):
+            if subscriber.connection in readable_fds:
+                # clients have nothing to say on this connection except closing it
+                try:
+                    if not subscriber.connection.recv(4096):
+                        self.drop(subscriber)
+                        continue
+                except socket.error as error:
+                    if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.drop(subscriber)
+                        continue
+
+            subscriber.pending_data += queued_data
+
+            if len(subscriber.pending_data) > self.pending_data_max:
+                # too slow to keep up, or gone without closing the connection
+                self.drop(subscriber)
+                continue
+
+            if subscriber.pending_data:
+                try:
+                    sent_data_length = subscriber.connection.send(subscriber.pending_data)
+                    subscriber.pending_data = subscriber.pending_data[sent_data_length:]
+                except socket.error as error:
+                    if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self.drop(subscriber)
+
+
+
+class ConnectionEventStream(object):
+
+    # stands in for a LightEventStream in another process; events are sent
+    # over a connection and published there by forward()
+
+    def __init__(self, connection):
+
+        self.connection = connection
+
+
+    def publish(self, event_name, event_data):
+
+        self.connection.send((event_name, event_data))
+
+
+    def close(self):
+
+        self.connection.send(None)
+
+
+    @staticmethod
+    def forward(connection, event_stream):
+
+        while True:
+            event = connection.recv()
+            if event is None:
+                break
+
+            event_stream.publish(*event)
+
+
+
+class WebAssetCache(object):
+
+    class Asset(object):
+
+        def __init__(self, contents, content_type, mtime):
+
+            import gzip
+            import hashlib
+
+            self.contents     = contents
+            self.content_type = content_type
+            self.mtime        = mtime
+
+            self.etag = '"%s"' % hashlib.sha1(contents).hexdigest()
+
+            # served in place of the original if the client accepts it and it is smaller
+            gzip_stream = StringIO.StringIO()
+            gzip_file = gzip.GzipFile(fileobj = gzip_stream, mode = 'wb', compresslevel = 9, mtime = 0)
+            gzip_file.write(contents)
+            gzip_file.close()
+
+            if len(gzip_stream.getvalue()) < len(contents):
+                self.gzip_contents = gzip_stream.getvalue()
+                self.gzip_etag = '"%s-gzip"' % self.etag[1:-1]
+            else:
+                self.gzip_contents = None
+                self.gzip_etag = None
+
+
+
+    def __init__(self, web_dir_path, max_age = 86400, check_mtime = False):
+
+        self.web_dir_path = web_dir_path
+        self.max_age      = max_age
+        self.check_mtime  = check_mtime
+
+        self.assets = {}
+        self.assets_lock = threading.Lock()
+
+
+    def preload(self):
+
+        for web_dir_path, web_dir_names, web_file_names in os.walk(self.web_dir_path):
+            for web_file_name in web_file_names:
+                self.get(os.path.relpath(os.path.join(web_dir_path, web_file_name), self.web_dir_path).replace(os.sep, '/'))
+
+
+    def get(self, web_file_name):
+
+        asset = self.assets.get(web_file_name)
+
+        if asset and not self.check_mtime:
+            return asset
+
+        if not re.match(r'^(([-\w]+\.)*[-\w]+/)*([-\w]+\.)*[-\w]+$', web_file_name):
+            return None
+
+        web_file_path = os.path.join(self.web_dir_path, *web_file_name.split('/'))
+
+        try:
+            web_file_mtime = os.path.getmtime(web_file_path)
+
+            if asset and asset.mtime == web_file_mtime:
+                return asset
+
+            with open(web_file_path, 'rb') as web_file:
+                web_file_contents = web_file.read()
+
+        except (IOError, OSError):
+            return None
+
+        try:
+            web_file_name_ext = os.path.splitext(web_file_name)[1]
+            web_file_type = SimpleHTTPServer.SimpleHTTPRequestHandler.extensions_map[web_file_name_ext]
+        except:
+            web_file_type = SimpleHTTPServer.SimpleHTTPRequestHandler.extensions_map['']
+
+        asset = self.Asset(web_file_contents, web_file_type, web_file_mtime)
+
+        self.assets_lock.acquire()
+        self.assets[web_file_name] = asset
+        self.assets_lock.release()
+
+        return asset
+
+
+    def cache_control(self, asset):
+
+        # pages are revalidated on every load so that updates show up, everything
+        # they refer to may be reused for a long time
+        if asset.content_type == 'text/html':
+            return 'no-cache'
+        else:
+            return 'public, max-age=%d' % self.max_age
+
+
+
+class ControlHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def setup(self):
+
+        # bounds how long a slow client can keep a worker waiting
+        self.timeout = self.server.request_timeout
+
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+
+    def do_GET(self):
+
+        request_start_time = time.time()
+
+        light_zone = self.light_zone()
+
+        if self.path == '/light':
+            self.do_get_light(self.server.light_controller)
+        elif light_zone:
+            self.do_get_light(light_zone[0])
+        elif self.path == '/light/events':
+            self.do_get_light_events()
+        elif self.path == '/metrics':
+            self.do_get_metrics()
+        else:
+            self.do_get_web(self.path)
+
+        self.observe_request(request_start_time)
+
+
+    def do_PUT(self):
+
+        request_start_time = time.time()
+
+        request_args = self.read_request_args()
+
+        light_zone = self.light_zone()
+
+        if self.path == '/light':
+            self.do_put_light(request_args, self.server.light_controller)
+        elif light_zone:
+            self.do_put_light(request_args, light_zone[0])
+        elif self.path == '/metrics':
+            self.do_put_metrics(request_args)
+        else:
+            self.send_empty_response(code = 404)
+
+        self.observe_request(request_start_time)
+
+
+    def do_POST(self):
+
+        request_start_time = time.time()
+
+        light_zone = self.light_zone()
+
+        if self.path == '/light':
+            self.do_post_light(self.read_request_args(), self.server.light_manager)
+        elif light_zone:
+            self.do_post_light(self.read_request_args(), light_zone[1])
+        elif self.path == '/light/batch':
+            self.do_post_light_batch(self.read_request_body())
+        else:
+            self.read_request_body()
+            self.send_empty_response(code = 404)
+
+        self.observe_request(request_start_time)
+
+
+    def light_zone(self):
+
+        # (light controller, light manager) of the zone named by /light/<zone>, if any
+        if not self.path.startswith('/light/'):
+            return None
+
+        return self.server.light_zones.get(self.path[len('/light/'):])
+
+
+    def observe_request(self, request_start_time):
+
+        metrics = self.server.metrics
+
+        if metrics and metrics.enabled:
+            if self.path in metrics.route_names:
+                metrics.observe_route(self.path, request_start_time)
+            elif self.light_zone():
+                metrics.observe_route('/light/<zone>', request_start_time)
+            elif self.command == 'GET':
+                metrics.observe_route('web', request_start_time)
+            else:
+                metrics.observe_route('unknown', request_start_time)
+
+
+    def read_request_body(self):
+
+        request_body_length = int(self.headers.get('Content-Length', 0))
+
+        return self.rfile.read(request_body_length)
+
+
+    def read_request_args(self):
+
+        return urlparse.parse_qs(self.read_request_body(), keep_blank_values = True)
+
+
+    def send_empty_response(self, code):
+
+        # persistent connections need an explicit (empty) body length
+        self.send_response(code = code)
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+
+    def do_get_light(self, light_controller):
+
+        light_state = light_controller.light_state()
+
+        if self.server.power_limited_light:
+            # for the whole strip, whichever zone was asked for
+            light_state['power'] = self.server.power_limited_light.power_state()
+
+        response_body = json.dumps(light_state) + '\n'
+
+        self.send_response(code = 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', len(response_body))
+        self.end_headers()
+
+        self.wfile.write(response_body)
+
+
+    def do_get_light_events(self):
+
+        self.send_response(code = 200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        # the event stream takes over the connection from here, and sends
+        # whatever the server has not yet sent ahead of the first event
+        self.close_connection = 1
+        pending_data = self.server.detach_request(self.request)
+
+        light_event_stream = self.server.light_event_stream
+        light_event_stream.subscribe(self.request,
+            pending_data + 'retry: 1000\n\n' + light_event_stream.encode_event('light', self.server.light_controller.light_state()))
+
+
+    def do_get_metrics(self):
+
+        metrics = self.server.metrics
+        light_controller = self.server.light_controller
+
+        if not metrics:
+            self.send_empty_response(code = 404)
+            return
+
+        metric_values = collections.OrderedDict((
+            ('metrics_enabled',      ('gauge',   'Whether timings are being collected.',        int(metrics.enabled))),
+            ('step_rate_target',     ('gauge',   'Configured frames per second.',               light_controller.step_rate)),
+        ))
+
+        # rendered in this process unless its commands go to a compositing
+        # process, whose counters and stage timings are not visible from here
+        rendered_here = (light_controller.layer_command_connection is None)
+
+        if rendered_here:
+            for metric_name, metric_type, metric_help, controller_metric_value in (
+                    ('frames_shown_total',   'counter', 'Frames sent to the light.',                lambda light_controller: light_controller.frames_shown),
+                    ('frames_skipped_total', 'counter', 'Frames identical to the previous one.',    lambda light_controller: light_controller.frames_skipped),
+                    ('frames_missed_total',  'counter', 'Frame deadlines missed, frames dropped.',  lambda light_controller: light_controller.frames_missed),
+                    ('frames_played_total',  'counter', 'Frames from precompiled transitions.',     lambda light_controller: light_controller.frames_played),
+                    ('step_rate_current',    'gauge',   'Frames per second currently aimed for.',   lambda light_controller: light_controller.step_rate_current),
+                    ('step_rate_achieved',   'gauge',   'Frames per second last rendered.',         lambda light_controller: light_controller.step_rate_achieved),
+                    ('layers',               'gauge',   'Layers currently being composited.',       lambda light_controller: len(light_controller.layers))):
+
+                # zones render on their own, so each gets a series; stage
+                # timings are shared and add up all of them
+                if self.server.light_zones:
+                    metric_value = collections.OrderedDict(
+                        (zone_name, controller_metric_value(zone_light_controller))
+                            for zone_name, (zone_light_controller, zone_light_manager)
+                            in self.server.light_zones.items())
+                else:
+                    metric_value = controller_metric_value(light_controller)
+
+                metric_values[metric_name] = (metric_type, metric_help, metric_value)
+
+        response_body = metrics.format_text(metric_values, stages_observed = rendered_here)
+
+        self.send_response(code = 200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', len(response_body))
+        self.end_headers()
+
+        self.wfile.write(response_body)
+
+
+    def do_put_metrics(self, request_args):
+
+        metrics = self.server.metrics
+
+        if not metrics:
+            self.send_empty_response(code = 404)
+            return
+
+        enabled = request_args.get('enabled', [None])[0]
+
+        if enabled in ('1', 'on', 'true'):
+            metrics.enabled = True
+        elif enabled in ('0', 'off', 'false'):
+            metrics.enabled = False
+        else:
+            self.send_empty_response(code = 400)
+            return
+
+        self.send_empty_response(code = 200)
+
+
+    def do_put_light(self, request_args, light_controller):
+
+        light_color = (
+            int(request_args['r'][0]),
+            int(request_args['g'][0]),
+            int(request_args['b'][0]))
+
+        transition_time = (float(request_args['time'][0]) if 'time' in request_args else 0.0)
+
+        light_controller.set_light_color(light_color, transition_time)
+
+        self.send_empty_response(code = 200)
+
+
+    def do_post_light(self, request_args, light_manager):
+
+        command = request_args['command'][0]
+
+        if command == 'on':
+            light_manager.switch_on()
+
+        elif command == 'off':
+            light_manager.switch_off()
+
+        elif command == 'cycle':
+            light_manager.cycle()
+
+        else:
+            self.send_empty_response(code = 400)
+            return
+
+        self.send_empty_response(code = 200)
+
+
+    def do_post_light_batch(self, request_body):
+
+        light_controller = self.server.light_controller
+        light_manager    = self.server.light_manager
+
+        # validate everything before applying anything
+        try:
+            batch_requests = json.loads(request_body)
+            if not isinstance(batch_requests, list):
+                raise ValueError('batch must be a list')
+
+            batch_operations = []
+
+            for batch_request in batch_requests:
+                if 'command' in batch_request:
+                    batch_operation = {
+                        'on':    light_manager.switch_on,
+                        'off':   light_manager.switch_off,
+                        'cycle': light_manager.cycle,
+                    }[batch_request['command']]
+
+                else:
+                    light_color = (
+                        int(batch_request['r']),
+                        int(batch_request['g']),
+                        int(batch_request['b']))
+
+                    transition_time = float(batch_request.get('time', 0.0))
+
+                    batch_operation = functools.partial(light_controller.set_light_color, light_color, transition_time)
+
+                batch_operations += [batch_operation]
+
+        except (ValueError, TypeError, KeyError):
+            self.send_empty_response(code = 400)
+            return
+
+        light_controller.apply_batch(batch_operations)
+
+        self.do_get_light(light_controller)
+
+
+    def do_get_web(self, path):
+
+        if path == '/':
+            web_file_name = 'index.html'
+        else:
+            web_file_name = path[1:]
+
+        asset = self.server.web_asset_cache.get(web_file_name)
+
+        if not asset:
+            self.send_empty_response(code = 404)
+            return
+
+        accept_encodings = [
+            accept_encoding.strip()
+                for accept_encoding
+                in self.headers.get('Accept-Encoding', '').split(',')]
+
+        if asset.gzip_contents and 'gzip' in accept_encodings:
+            web_file_contents = asset.gzip_contents
+            web_file_etag     = asset.gzip_etag
+            web_file_encoding = 'gzip'
+        else:
+            web_file_contents = asset.contents
+            web_file_etag     = asset.etag
+            web_file_encoding = None
+
+        if_none_match_etags = [
+            if_none_match_etag.strip()
+                for if_none_match_etag
+                in self.headers.get('If-None-Match', '').split(',')]
+
+        web_file_not_modified = (web_file_etag in if_none_match_etags or '*' in if_none_match_etags)
+
+        if web_file_not_modified:
+            self.send_response(code = 304)
+        else:
+            self.send_response(code = 200)
+            self.send_header('Content-Type', asset.content_type)
+            self.send_header('Content-Length', len(web_file_contents))
+            if web_file_encoding:
+                self.send_header('Content-Encoding', web_file_encoding)
+
+        self.send_header('ETag', web_file_etag)
+        self.send_header('Cache-Control', self.server.web_asset_cache.cache_control(asset))
+        if asset.gzip_contents:
+            self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+
+        if not web_file_not_modified:
+            self.wfile.write(web_file_contents)
+
+
+
+class PersistentControlHTTPRequestHandler(ControlHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    keep_alive_waiting = False
+
+
+    def handle(self):
+
+        self.close_connection = 1
+        self.handle_one_request()
+
+        while not self.close_connection:
+            # an idle connection waits only keep_alive_timeout for its next
+            # request, so that it cannot hold on to a pooled worker for long
+            self.keep_alive_waiting = True
+            self.connection.settimeout(self.server.keep_alive_timeout)
+            self.handle_one_request()
+
+
+    def parse_request(self):
+
+        # the next request has begun; the rest of it gets the full timeout
+        if self.keep_alive_waiting:
+            self.keep_alive_waiting = False
+            self.connection.settimeout(self.timeout)
+
+        return ControlHTTPRequestHandler.parse_request(self)
+
+
+    def log_error(self, format, *args):
+
+        # an idle connection timing out is routine, not an error
+        if not self.keep_alive_waiting:
+            ControlHTTPRequestHandler.log_error(self, format, *args)
+
+
+
+class ControlHTTPServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, server_address, request_handler_class):
+
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, request_handler_class)
+
+        self.detached_requests = set()
+        self.detached_requests_lock = threading.Lock()
+
+
+    def detach_request(self, request):
+
+        # connection is kept open after the request handler is done with it;
+        # -> data still to be sent on it, none as handlers write unbuffered
+        self.detached_requests_lock.acquire()
+        self.detached_requests.add(request)
+        self.detached_requests_lock.release()
+
+        return ''
+
+
+    def shutdown_request(self, request):
+
+        self.detached_requests_lock.acquire()
+        request_detached = (request in self.detached_requests)
+        self.detached_requests.discard(request)
+        self.detached_requests_lock.release()
+
+        if not request_detached:
+            BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+
+
+class PooledHTTPServer(ControlHTTPServer):
 
+    # accepted connections are queued to a fixed number of worker threads,
+    # so slow clients only ever tie up their own worker
 
-    def cycle(self):
+    def __init__(self, server_address, request_handler_class, worker_count = 4):
+
+        ControlHTTPServer.__init__(self, server_address, request_handler_class)
+
+        self.request_queue = Queue.Queue()
+
+        self.worker_threads = [threading.Thread(target = self.worker_thread_proc) for worker_index in xrange(worker_count)]
+        for worker_thread in self.worker_threads:
+            worker_thread.daemon = True
+            worker_thread.start()
+
+
+    def process_request(self, request, client_address):
+
+        self.request_queue.put((request, client_address))
+
+
+    def worker_thread_proc(self):
+
+        while True:
+            queued_request = self.request_queue.get()
+            if queued_request is None:
+                break
+
+            request, client_address = queued_request
 
-        if self.is_off():
-            self.switch_on()
-        else:
             try:
-                curr_cycle_light_color_index = self.cycle_light_colors.index(self.light_controller.light_color)
-                next_cycle_light_color = self.cycle_light_colors[(curr_cycle_light_color_index + 1) % len(self.cycle_light_colors)]
+                self.finish_request(request, client_address)
             except:
-                next_cycle_light_color = self.cycle_light_colors[0]
+                self.handle_error(request, client_address)
 
-            self.light_controller.set_light_color(next_cycle_light_color, self.cycle_transition_time)
+            self.shutdown_request(request)
 
 
+    def server_close(self):
 
-class ControlHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        ControlHTTPServer.server_close(self)
 
-    def do_GET(self):
+        for worker_thread in self.worker_threads:
+            self.request_queue.put(None)
 
-        if self.path == '/light':
-            self.do_get_light()
-        else:
-            self.do_get_web(self.path)
 
 
-    def do_PUT(self):
+class EventLoopControlHTTPRequestHandler(PersistentControlHTTPRequestHandler):
 
-        request_body_length = int(self.headers['Content-Length'])
-        request_body = self.rfile.read(request_body_length)
-        request_args = urlparse.parse_qs(request_body, keep_blank_values = True)
+    # handles one request the event loop has already read in full; the response
+    # is collected for the loop to send without blocking
 
-        if self.path == '/light':
-            self.do_put_light(request_args)
-        else:
-            self.send_response(code = 404)
+    def setup(self):
 
+        self.connection = self.request
 
-    def do_POST(self):
+        self.rfile = StringIO.StringIO(self.server.request_data)
+        self.wfile = StringIO.StringIO()
 
-        request_body_length = int(self.headers['Content-Length'])
-        request_body = self.rfile.read(request_body_length)
-        request_args = urlparse.parse_qs(request_body, keep_blank_values = True)
+        # headers written so far, should the request be detached
+        self.server.request_wfile = self.wfile
 
-        if self.path == '/light':
-            self.do_post_light(request_args)
-        else:
-            self.send_response(code = 404)
 
-    
-    def do_get_light(self):
+    def handle(self):
 
-        self.send_response(code = 200)
-        self.send_header('Content-Type', 'application/json')
-        self.end_headers()
+        self.handle_one_request()
 
-        self.wfile.write(
-            json.dumps(collections.OrderedDict((
-                ('r', self.server.light_controller.light_color[0]),
-                ('g', self.server.light_controller.light_color[1]),
-                ('b', self.server.light_controller.light_color[2]),
-            ))))
-        self.wfile.write('\n')
 
+    def finish(self):
 
-    def do_put_light(self, request_args):
+        self.response_data = self.wfile.getvalue()
 
-        light_color = (
-            int(request_args['r'][0]),
-            int(request_args['g'][0]),
-            int(request_args['b'][0]))
 
-        transition_time = (float(request_args['time'][0]) if 'time' in request_args else 0.0)
 
-        self.server.light_controller.set_light_color(light_color, transition_time)
-        self.send_response(code = 200)
+class EventLoopHTTPServer(object):
 
+    # HTTP control, rendering and the event stream on a single thread: one select()
+    # waits for connections, published events and the next frame deadline,
+    # whichever comes first, so nothing needs a lock or a thread switch
 
-    def do_post_light(self, request_args):
+    class Connection(object):
 
-        command = request_args['command'][0]
+        def __init__(self, connection, client_address, activity_time):
 
-        if command == 'on':
-            self.server.light_manager.switch_on()
-            self.send_response(code = 200)
+            self.connection     = connection
+            self.client_address = client_address
+            self.activity_time  = activity_time
 
-        elif command == 'off':
-            self.server.light_manager.switch_off()
-            self.send_response(code = 200)
+            self.input_data  = ''
+            self.output_data = ''
+            self.close_after_output = False
 
-        elif command == 'cycle':
-            self.server.light_manager.cycle()
-            self.send_response(code = 200)
 
-        else:
-            self.send_response(code = 400)
 
+    request_header_size_max = 65536
 
-    def do_get_web(self, path):
+    content_length_pattern = re.compile(r'^content-length:\s*(\d+)\s*$', re.IGNORECASE | re.MULTILINE)
 
-        if path == '/':
-            web_file_name = 'index.html'
-        else:
-            web_file_name = path[1:]
 
-        if not re.match(r'^(([-\w]+\.)*[-\w]+/)*([-\w]+\.)*[-\w]+$', web_file_name):
-            self.send_response(code = 404)
+    def __init__(self, server_address, request_handler_class, render_light_controllers):
 
-        else:
-            web_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'web', *web_file_name.split('/'))
+        self.request_handler_class = request_handler_class
+        self.render_light_controllers = render_light_controllers
 
-            try:
-                with open(web_file_path, 'r') as web_file:
-                    web_file_contents = web_file.read()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(16)
+        self.socket.setblocking(0)
+
+        server_host, self.server_port = self.socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(server_host)
+
+        self.connections = {}
+
+        self.request_timeout = 10.0
+        self.light_event_stream = None
+
+        self.request_data = None
+        self.request_wfile = None
+        self.request_detached = False
+
+        self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+        fcntl.fcntl(self.wakeup_read_fd,  fcntl.F_SETFL, fcntl.fcntl(self.wakeup_read_fd,  fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(self.wakeup_write_fd, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.serving = False
+
+
+    def serve_forever(self, poll_interval = None):
 
+        # poll_interval is accepted for symmetry with SocketServer; the loop
+        # wakes up exactly when there is something to do
+        self.serving = True
+
+        step_due_times = []
+
+        # a first step right away, like a layer thread starting up
+        for light_controller in self.render_light_controllers:
+            light_controller.start_render_steps()
+            step_due_times += [light_controller.clock()]
+
+        while self.serving:
+            self.render_due_steps(step_due_times)
+
+            # seconds until something is due; none at all when idle
+            select_timeouts = []
+
+            for controller_index, light_controller in enumerate(self.render_light_controllers):
+                if step_due_times[controller_index] is not None:
+                    select_timeouts += [max(0.0, step_due_times[controller_index] - light_controller.clock())]
+
+            read_fds  = [self.socket, self.wakeup_read_fd] + self.connections.keys()
+            write_fds = [connection.connection for connection in self.connections.values() if connection.output_data]
+
+            if self.connections:
+                # idle or stalled connections are closed after request_timeout
+                activity_time_min = min(connection.activity_time for connection in self.connections.values())
+                select_timeouts += [max(0.0, activity_time_min + self.request_timeout - time.time())]
+
+            light_event_stream = self.light_event_stream
+            if light_event_stream:
+                stream_read_fds, stream_write_fds, stream_timeout = light_event_stream.stream_fds()
+                read_fds  += stream_read_fds
+                write_fds += stream_write_fds
+                select_timeouts += [stream_timeout]
+
+            try:
+                readable_fds, writable_fds, error_fds = select.select(read_fds, write_fds, [], (min(select_timeouts) if select_timeouts else None))
+            except select.error as error:
+                # a signal handler ran; it may have asked to shut down
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wakeup_read_fd in readable_fds:
                 try:
-                    web_file_name_ext = os.path.splitext(web_file_name)[1]
-                    web_file_type = SimpleHTTPServer.SimpleHTTPRequestHandler.extensions_map[web_file_name_ext]
-                except:
-                    web_file_type = SimpleHTTPServer.SimpleHTTPRequestHandler.extensions_map['']
+                    os.read(self.wakeup_read_fd, 4096)
+                except OSError as error:
+                    if error.errno != errno.EAGAIN:
+                        raise
+
+            if self.socket in readable_fds:
+                self.accept_connections()
+
+            for connection_socket in readable_fds:
+                if connection_socket in self.connections:
+                    self.read_connection(self.connections[connection_socket])
+
+            # frames for commands just posted go out before the responses do
+            self.render_due_steps(step_due_times)
+
+            for connection in self.connections.values():
+                if connection.output_data or connection.close_after_output:
+                    self.write_connection(connection)
+
+            if light_event_stream:
+                light_event_stream.stream_step(readable_fds, writable_fds)
+
+            for connection in self.connections.values():
+                if time.time() - connection.activity_time >= self.request_timeout:
+                    self.close_connection(connection)
+
+        for connection in self.connections.values():
+            self.close_connection(connection)
+
+        if self.light_event_stream:
+            self.light_event_stream.drop_all()
+
+
+    def render_due_steps(self, step_due_times):
+
+        # steps that are due, or that have commands posted by requests
+        for controller_index, light_controller in enumerate(self.render_light_controllers):
+            step_due_time = step_due_times[controller_index]
+
+            if (light_controller.layer_commands if step_due_time is None else light_controller.clock() >= step_due_time):
+                step_wait_duration = light_controller.render_step()
+                step_due_times[controller_index] = (None if step_wait_duration is None else light_controller.clock() + step_wait_duration)
+
+
+    def shutdown(self):
+
+        # only sets a flag and writes to a pipe, so it is safe to call from a
+        # signal handler interrupting the loop itself
+        self.serving = False
+
+        try:
+            os.write(self.wakeup_write_fd, 'x')
+        except OSError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+
+
+    def server_close(self):
+
+        # the wakeup pipe stays open, shutdown may still be called by a signal
+        self.socket.close()
+
+
+    def accept_connections(self):
+
+        while True:
+            try:
+                connection_socket, client_address = self.socket.accept()
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    break
+                raise
+
+            connection_socket.setblocking(0)
+            self.connections[connection_socket] = self.Connection(connection_socket, client_address, time.time())
+
+
+    def close_connection(self, connection):
+
+        del self.connections[connection.connection]
+
+        try:
+            connection.connection.close()
+        except socket.error:
+            pass
+
+
+    def read_connection(self, connection):
+
+        try:
+            received_data = connection.connection.recv(65536)
+        except socket.error as error:
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close_connection(connection)
+            return
+
+        if not received_data:
+            self.close_connection(connection)
+            return
+
+        connection.activity_time = time.time()
+        connection.input_data += received_data
+
+        # pipelined requests are handled in order, each once complete
+        while connection.connection in self.connections and not connection.close_after_output:
+            request_header_end = connection.input_data.find('\r\n\r\n')
+
+            if request_header_end < 0:
+                if len(connection.input_data) > self.request_header_size_max:
+                    self.close_connection(connection)
+                return
+
+            content_length_match = self.content_length_pattern.search(connection.input_data, 0, request_header_end)
+            request_size = request_header_end + 4 + (int(content_length_match.group(1)) if content_length_match else 0)
+
+            if len(connection.input_data) < request_size:
+                return
+
+            request_data = connection.input_data[:request_size]
+            connection.input_data = connection.input_data[request_size:]
+
+            self.handle_request(connection, request_data)
+
+
+    def handle_request(self, connection, request_data):
+
+        self.request_data = request_data
+        self.request_detached = False
+
+        try:
+            request_handler = self.request_handler_class(connection.connection, connection.client_address, self)
+        except:
+            self.handle_error(connection.connection, connection.client_address)
+            self.close_connection(connection)
+            return
+        finally:
+            self.request_data = None
+            self.request_wfile = None
+
+        if self.request_detached:
+            # the event stream owns the socket now
+            del self.connections[connection.connection]
+            return
+
+        connection.output_data += request_handler.response_data
+
+        if request_handler.close_connection:
+            connection.close_after_output = True
+
+
+    def write_connection(self, connection):
+
+        if connection.output_data:
+            try:
+                sent_data_length = connection.connection.send(connection.output_data)
+                connection.output_data = connection.output_data[sent_data_length:]
+                connection.activity_time = time.time()
+            except socket.error as error:
+                if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close_connection(connection)
+                    return
+
+        if not connection.output_data and connection.close_after_output:
+            self.close_connection(connection)
+
+
+    def detach_request(self, request):
+
+        # the event stream writes to the socket from here on, without ever
+        # blocking; -> data still buffered for it, for the stream to send first
+        self.request_detached = True
 
-                self.send_response(code = 200)
-                self.send_header('Content-Type', web_file_type)
-                self.send_header('Content-Length', len(web_file_contents))
-                self.end_headers()
+        connection = self.connections[request]
 
-                self.wfile.write(web_file_contents)
+        pending_data = connection.output_data + self.request_wfile.getvalue()
+        self.request_wfile.truncate(0)
 
-            except IOError:
-                self.send_response(code = 404)
+        return pending_data
+
+
+    def handle_error(self, request, client_address):
+
+        print >>sys.stderr, 'Exception while handling request from %s:' % (client_address,)
+        traceback.print_exc()
+
+
+
+def argparse_positive_int(arg):
+    positive_int = int(arg)
+    if positive_int < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer')
+    return positive_int
+
+
+def argparse_positive_float(arg):
+    positive_float = float(arg)
+    if positive_float <= 0.0:
+        raise argparse.ArgumentTypeError('must be a positive number')
+    return positive_float
+
+
+def argparse_ip_hostname(arg):
+    ip_hostname = arg;
+    if not re.match(r'^([-0-9A-Za-z]{1,63}\.)*[-0-9A-Za-z]{1,63}$', ip_hostname):
+        raise argparse.ArgumentTypeError('must be a hostname (an IP address or sequence of labels separated by dots)')
+    if len(ip_hostname) > 253:
+        raise argparse.ArgumentTypeError('must not be longer than 253 characters')
+    return ip_hostname
+
+
+def argparse_channel_milliamps(arg):
+    channel_milliamps = tuple(float(channel) for channel in arg.split(','))
+    if len(channel_milliamps) != 3 or min(channel_milliamps) < 0.0:
+        raise argparse.ArgumentTypeError('must be three non-negative numbers separated by commas (mA for red, green, blue)')
+    return channel_milliamps
+
+
+def argparse_white_balance(arg):
+    white_balance = tuple(float(channel) for channel in arg.split(','))
+    if len(white_balance) != 3 or min(white_balance) < 0.0 or max(white_balance) > 1.0:
+        raise argparse.ArgumentTypeError('must be three numbers from 0 to 1 separated by commas (red, green, blue)')
+    return white_balance
+
+
+def argparse_ip_port(arg):
+    ip_port = int(arg)
+    if ip_port <= 0:
+        raise argparse.ArgumentTypeError('must be a positive integer')
+    if ip_port > 65535:
+        raise argparse.ArgumentTypeError('must not be greater than 65535')
+    return ip_port
+
+
+
+class LightDriver(object):
+
+    # a light driver selectable by name with --light-driver; the modules it
+    # needs are only imported once it has been selected, and it brings its own
+    # command line options as (option, add_argument keywords) pairs, which
+    # drivers may share; subclasses provide create_light(strip_size, args)
+
+    name = None
+    description = ''
+    module_names = ()
+    arguments = ()
+
+
+    def __init__(self):
+
+        self.import_duration = None
+
+
+    def import_modules(self):
+
+        # -> seconds spent importing; ImportError if the driver cannot run here
+        import_start_time = time.time()
+
+        for module_name in self.module_names:
+            __import__(module_name)
+
+        self.import_duration = time.time() - import_start_time
+
+        return self.import_duration
+
+
+
+class NeopixelLightDriver(LightDriver):
+
+    name = 'neopixel'
+    description = 'WS281x strip on a Raspberry Pi GPIO pin'
+    module_names = ('neopixel',)
+    arguments = (
+        ('--neopixel-pin',        dict(type = argparse_positive_int, default = 18)),
+        ('--neopixel-brightness', dict(type = argparse_positive_int, default = 255)))
+
+    def create_light(self, strip_size, args):
+        return NeopixelLight(strip_size = strip_size, strip_pin = args.neopixel_pin, strip_brightness = args.neopixel_brightness)
+
+
+
+class ConsoleLightDriver(LightDriver):
+
+    name = 'console'
+    description = 'colored blocks on the terminal'
+    arguments = (
+        ('--console-truecolor', dict(action = 'store_true')),)
+
+    def create_light(self, strip_size, args):
+        return ConsoleLight(strip_size = strip_size, write_prefix = '\r', write_suffix = '\n', truecolor = args.console_truecolor)
+
+
+
+class NullLightDriver(LightDriver):
+
+    name = 'null'
+    description = 'discards frames'
+
+    def create_light(self, strip_size, args):
+        return NullLight(strip_size = strip_size)
+
+
+
+class TimingLightDriver(NullLightDriver):
+
+    # the timing wrapper itself is added for any driver with --profile
+    name = 'timing'
+    description = 'discards frames, reporting frame timing'
+
+
+
+class DDPLightDriver(LightDriver):
+
+    name = 'ddp'
+    description = 'DDP over UDP, to WLED and similar controllers'
+    arguments = (
+        ('--light-host', dict(type = argparse_ip_hostname, default = None)),
+        ('--light-port', dict(type = argparse_ip_port,     default = None)))
+
+    def create_light(self, strip_size, args):
+        return DDPLight(strip_size = strip_size, host = args.light_host or '127.0.0.1', port = args.light_port)
+
+
+
+class E131LightDriver(LightDriver):
+
+    name = 'e131'
+    description = 'E1.31 (streaming ACN) over UDP, unicast or multicast'
+    module_names = ('uuid',)
+    arguments = DDPLightDriver.arguments + (
+        ('--light-universe', dict(type = argparse_positive_int, default = 1)),)
+
+    def create_light(self, strip_size, args):
+        return E131Light(strip_size = strip_size, host = args.light_host, port = args.light_port, universe_start = args.light_universe)
+
+
+
+# by name, in the order listed by --list-drivers
+light_drivers = collections.OrderedDict()
+
+
+def register_light_driver(light_driver):
+
+    if not light_driver.name or not callable(getattr(light_driver, 'create_light', None)):
+        raise ValueError('not a light driver: %r' % light_driver)
+
+    light_drivers[light_driver.name] = light_driver
+
+
+def find_light_driver(light_driver_name):
+
+    # built in, or registered by a module named ambientlight_driver_<name> on
+    # the module search path, imported the first time it is asked for
+    if light_driver_name not in light_drivers and re.match(r'^[A-Za-z0-9_]+$', light_driver_name):
+        import imp
+
+        try:
+            imp.find_module('ambientlight_driver_' + light_driver_name)
+        except ImportError:
+            return None
+
+        __import__('ambientlight_driver_' + light_driver_name)
+
+    return light_drivers.get(light_driver_name)
+
+
+for builtin_light_driver in (NeopixelLightDriver(), ConsoleLightDriver(), TimingLightDriver(), NullLightDriver(), DDPLightDriver(), E131LightDriver()):
+    register_light_driver(builtin_light_driver)
+
+
+
+def run_compositing_process(light_controller, layer_command_connection):
+
+    # compositing role: renders the commands sent by the control process into
+    # the frame ring behind light_controller.light
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    light_controller.start()
+    light_controller.receive_layer_commands(layer_command_connection)
+    light_controller.stop()
+
+    light_controller.light.close()
+
+    if light_controller.event_stream:
+        light_controller.event_stream.close()
+
+    print 'Compositing: showed %d frames, skipped %d unchanged frames, dropped %d late frames.' % (light_controller.frames_shown, light_controller.frames_skipped, light_controller.frames_missed)
+
+
+def run_output_process(frame_ring, create_light):
+
+    # output role: shows the newest frame in the ring, skipping any that were
+    # overtaken while the light was busy
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    light = create_light()
+    frame = bytearray(frame_ring.frame_size)
+
+    while not frame_ring.closed():
+        frame_ring.wait(0.5)
+
+        if frame_ring.read(frame):
+            if frame_ring.skipped():
+                light.skip_show()
+
+            light.set_frame(frame)
+            light.show()
+
+    if isinstance(light, TimingLight):
+        light.stop()
+
+    light.close()
+
+    print 'Output: skipped %d frames overtaken by newer ones.' % frame_ring.dropped_frame_count
 
 
 
@@ -657,60 +4769,315 @@ class ControlHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
 if __name__ == '__main__':
 
-    def argparse_positive_int(arg):
-        positive_int = int(arg)
-        if positive_int < 1:
-            raise argparse.ArgumentTypeError('must be a positive integer')
-        return positive_int
-
-    def argparse_ip_hostname(arg):
-        ip_hostname = arg;
-        if not re.match(r'^([-0-9A-Za-z]{1,63}\.)*[-0-9A-Za-z]{1,63}$', ip_hostname):
-            raise argparse.ArgumentTypeError('must be a hostname (an IP address or sequence of labels separated by dots)')
-        if len(ip_hostname) > 253:
-            raise argparse.ArgumentTypeError('must not be longer than 253 characters')
-        return ip_hostname
-
-    def argparse_ip_port(arg):
-        ip_port = int(arg)
-        if ip_port <= 0:
-            raise ArgumentTypeError('must be a positive integer')
-        if ip_port > 65535:
-            raise ArgumentTypeError('must not be greater than 65535')
-        return ip_port
-
-    argparser = argparse.ArgumentParser(description = 'Ambient light control server.')
-
-    argparser.add_argument('--step-rate',      type = argparse_positive_int,                default = 60)
-    argparser.add_argument('--light-count',    type = argparse_positive_int,                default = 16)
-    argparser.add_argument('--light-driver',   choices = ['neopixel', 'console', 'timing'], default = 'neopixel')
-    argparser.add_argument('--server-address', type = argparse_ip_hostname,                 default = None)
-    argparser.add_argument('--server-port',    type = argparse_ip_port,                     default = 8000)
+    startup_start_time = time.time()
+
+    # driver plugins import ambientlight to register themselves, which must
+    # find this module rather than load a second copy with its own registry
+    sys.modules.setdefault('ambientlight', sys.modules['__main__'])
+
+    # help is added once the options of the selected driver are known
+    argparser = argparse.ArgumentParser(description = 'Ambient light control server.', add_help = False)
+
+    argparser.add_argument('--step-rate',           type = argparse_positive_int,                        default = 60)
+    argparser.add_argument('--adaptive-step-rate',  action = 'store_true')
+    argparser.add_argument('--min-step-rate',       type = argparse_positive_int,                        default = 15)
+    argparser.add_argument('--light-count',         type = argparse_positive_int,                        default = 16)
+    argparser.add_argument('--light-driver',        type = str,                                          default = 'neopixel')
+    argparser.add_argument('--list-drivers',        action = 'store_true')
+    argparser.add_argument('--server-address',      type = argparse_ip_hostname,                         default = None)
+    argparser.add_argument('--server-port',         type = argparse_ip_port,                             default = 8000)
+    argparser.add_argument('--server-mode',         choices = ['single', 'pooled'],                      default = 'single')
+    argparser.add_argument('--server-workers',      type = argparse_positive_int,                        default = None)
+    argparser.add_argument('--request-timeout',     type = argparse_positive_float,                      default = 10.0)
+    argparser.add_argument('--keep-alive-timeout',  type = argparse_positive_float,                      default = 1.0)
+    argparser.add_argument('--compositor',          choices = ['auto', 'numpy', 'python'],               default = 'auto')
+    argparser.add_argument('--layer-sampling',      choices = ['interpolate', 'table'],                  default = 'interpolate')
+    argparser.add_argument('--partial-updates',     action = 'store_true')
+    argparser.add_argument('--precompile',          action = 'store_true')
+    argparser.add_argument('--coalesce-window',     type = float,                                        default = 0.0)
+    argparser.add_argument('--web-max-age',         type = argparse_positive_int,                        default = 86400)
+    argparser.add_argument('--web-preload',         action = 'store_true')
+    argparser.add_argument('--web-check-mtime',     action = 'store_true')
+    argparser.add_argument('--event-heartbeat',     type = argparse_positive_float,                      default = 15.0)
+    argparser.add_argument('--event-progress-rate', type = float,                                        default = 10.0)
+    argparser.add_argument('--profile',             action = 'store_true')
+    argparser.add_argument('--profile-interval',    type = argparse_positive_float,                      default = 5.0)
+    argparser.add_argument('--profile-frames',      type = argparse_positive_int,                        default = 4096)
+    argparser.add_argument('--profile-trace-path',  type = str,                                          default = 'ambientlight-trace.txt')
+    argparser.add_argument('--metrics',             action = 'store_true')
+    argparser.add_argument('--zones',               type = str,                                          default = None)
+    argparser.add_argument('--process-mode',        choices = ['threads', 'processes', 'eventloop'],     default = 'threads')
+    argparser.add_argument('--record-path',         type = str,                                          default = None)
+    argparser.add_argument('--replay-path',         type = str,                                          default = None)
+    argparser.add_argument('--replay-speed',        type = float,                                        default = 1.0)
+    argparser.add_argument('--power-budget',        type = argparse_positive_float,                      default = None)
+    argparser.add_argument('--power-milliamps',     type = argparse_channel_milliamps,                   default = None)
+    argparser.add_argument('--gamma',               type = argparse_positive_float,                      default = None)
+    argparser.add_argument('--white-balance',       type = argparse_white_balance,                       default = None)
+    argparser.add_argument('--dithering',           action = 'store_true')
+
+    # options of the drivers known so far, each added once even if shared
+    light_driver_options = set()
+
+    def add_light_driver_arguments(light_driver):
+        light_driver_arguments = [(option, keywords) for option, keywords in light_driver.arguments if option not in light_driver_options]
+        if light_driver_arguments:
+            # titled after every driver known to share them
+            argument_group_names = [other_light_driver.name for other_light_driver in light_drivers.values() if light_driver_arguments[0] in other_light_driver.arguments]
+            argument_group = argparser.add_argument_group('%s light driver options' % ', '.join(argument_group_names or [light_driver.name]))
+            for option, keywords in light_driver_arguments:
+                argument_group.add_argument(option, **keywords)
+                light_driver_options.add(option)
+
+    for light_driver in light_drivers.values():
+        add_light_driver_arguments(light_driver)
+
+    # a driver from a plugin module adds its options once it has been found
+    known_args, unknown_args = argparser.parse_known_args()
+
+    if known_args.list_drivers:
+        import pkgutil
+
+        for plugin_module_name in sorted(set(module_name for _, module_name, _ in pkgutil.iter_modules() if module_name.startswith('ambientlight_driver_'))):
+            find_light_driver(plugin_module_name[len('ambientlight_driver_'):])
+
+        # nothing else imports the modules of a driver, so each is timed cold
+        for light_driver in light_drivers.values():
+            try:
+                print '%-10s %8.1f ms   %s' % (light_driver.name, light_driver.import_modules() * 1000.0, light_driver.description)
+            except ImportError as error:
+                print '%-10s %8s      %s (unavailable: %s)' % (light_driver.name, '-', light_driver.description, error)
+        sys.exit(0)
+
+    light_driver = find_light_driver(known_args.light_driver)
+
+    if not light_driver:
+        argparser.error('--light-driver: no driver named %s (see --list-drivers)' % known_args.light_driver)
+
+    add_light_driver_arguments(light_driver)
+
+    argparser.add_argument('-h', '--help', action = 'help', help = 'show this help message and exit')
 
     args = argparser.parse_args()
 
+    try:
+        light_driver.import_modules()
+    except ImportError as error:
+        argparser.error('--light-driver %s: %s' % (light_driver.name, error))
+
+    # created by create_light in this process, for GET /light to report on
+    power_limited_lights = []
+
+    def create_light():
+        light = light_driver.create_light(args.light_count, args)
+
+        if args.power_budget:
+            # next to the driver, so that recordings and replays are limited too
+            light = PowerLimitedLight(light, args.power_budget, channel_milliamps = args.power_milliamps)
+            power_limited_lights.append(light)
+
+        if args.record_path:
+            light = RecordingLight(light, args.record_path)
+
+        if args.light_driver == 'timing' or args.profile:
+            # frame timing summaries for any driver, plus a raw trace on SIGUSR1
+            light = TimingLight(
+                light,
+                step_rate        = args.step_rate,
+                interval_count   = args.profile_frames,
+                summary_interval = args.profile_interval,
+                trace_path       = args.profile_trace_path,
+                write_suffix     = '\n')
+
+            signal.signal(signal.SIGUSR1, lambda signal, frame: light.request_trace())
+
+            light.start()
+
+        return light
+
+    # composited at high precision and corrected on the way to the light
+    color_correction_enabled = (args.gamma is not None or args.white_balance is not None or args.dithering)
+
+    def create_light_controller(light, event_stream, metrics = None, layer_command_connection = None):
+        if color_correction_enabled:
+            # one per controller, dithering keeps errors per pixel
+            color_correction = create_color_correction(
+                args.compositor,
+                light.strip_size,
+                gamma         = (args.gamma if args.gamma is not None else 1.0),
+                white_balance = (args.white_balance or (1.0, 1.0, 1.0)),
+                dithering     = args.dithering)
+        else:
+            color_correction = None
+
+        return LightController(
+            light,
+            step_rate                = args.step_rate,
+            compositor               = create_compositor(args.compositor, table_sampling = (args.layer_sampling == 'table'), high_precision = color_correction_enabled),
+            partial_updates          = args.partial_updates,
+            event_stream             = event_stream,
+            progress_rate            = args.event_progress_rate,
+            coalesce_window          = args.coalesce_window,
+            metrics                  = metrics,
+            adaptive_step_rate       = args.adaptive_step_rate,
+            min_step_rate            = args.min_step_rate,
+            layer_command_connection = layer_command_connection,
+            precompile_transitions   = args.precompile,
+            color_correction         = color_correction)
+
+    def create_light_manager(light_controller):
+        return LightManager(
+            light_controller,
+            cycle_light_colors = [
+                (255,80,12),    # warm orange
+                (255,160,64)],  # nice natural white
+            cycle_transition_time = 2.0,
+            off_transition_time   = 2.0)
+
+    if args.process_mode == 'eventloop' and (args.server_mode == 'pooled' or args.server_workers):
+        # the event loop serves requests itself, on the render thread
+        argparser.error('--server-mode pooled and --server-workers require --process-mode threads or processes')
+
+    if args.zones:
+        if args.process_mode == 'processes':
+            argparser.error('--zones requires --process-mode threads or eventloop')
+
+        try:
+            zone_pixel_maps = load_zone_pixel_maps(args.zones, args.light_count)
+        except (IOError, ValueError, KeyError, TypeError) as error:
+            argparser.error('--zones: %s' % error)
+
+    if args.replay_path:
+        # shows a capture on the light instead of serving requests
+        frame_capture = FrameCapture(args.replay_path)
+        args.light_count = frame_capture.strip_size
+
+        light = create_light()
+
+        print 'Replaying %d frames of %d pixels from %s.' % (frame_capture.frame_count, frame_capture.strip_size, args.replay_path)
+
+        try:
+            replay_capture(frame_capture, light, speed = args.replay_speed)
+        except KeyboardInterrupt:
+            pass
+
+        frame_capture.close()
+
+        if isinstance(light, TimingLight):
+            light.stop()
+
+        light.close()
+
+        print 'Exiting.'
+        sys.exit(0)
+
+    light_event_stream = LightEventStream(
+        heartbeat_interval = args.event_heartbeat)
+
+    metrics = Metrics(enabled = args.metrics)
+
+    # (light controller, light manager) by zone name, for /light/<zone>
+    light_zones = collections.OrderedDict()
+
+    if args.process_mode in ('threads', 'eventloop'):
+        light = create_light()
+
+        if args.process_mode == 'eventloop' and light.show_blocks:
+            # the event loop renders and serves requests on one thread, which
+            # must not wait for frames to go out
+            output_light = BackgroundShowLight(light)
+        else:
+            output_light = light
+
+        if args.zones:
+            # one controller per zone, all scattering into the same strip, which
+            # one loop steps and shows; the first zone is also served on /light
+            # and streams its events
+            zone_strip = ZoneStrip(output_light)
+
+            for zone_name, pixel_map in zone_pixel_maps.items():
+                zone_light_controller = create_light_controller(MappedLight(output_light, pixel_map, zone_strip), (None if light_zones else light_event_stream), metrics = metrics)
+                light_zones[zone_name] = (zone_light_controller, create_light_manager(zone_light_controller))
+
+            light_controller = light_zones.values()[0][0]
+
+            render_light_controllers = [ZoneRenderLoop([zone_controller for zone_controller, zone_manager in light_zones.values()], zone_strip)]
+
+        else:
+            light_controller = create_light_controller(MappedLight(output_light, PixelMap.mirrored(output_light.strip_size)), light_event_stream, metrics = metrics)
+
+            render_light_controllers = [light_controller]
+
+    if args.process_mode == 'processes':
+        # compositing and output in processes of their own, forked before this
+        # one starts any threads; /metrics leaves out what they render
+        import multiprocessing
+
+        frame_ring = FrameRing(args.light_count)
+
+        layer_command_receiver, layer_command_sender = multiprocessing.Pipe(duplex = False)
+        light_event_receiver,   light_event_sender   = multiprocessing.Pipe(duplex = False)
+
+        render_processes = [
+            multiprocessing.Process(target = run_compositing_process, args = (create_light_controller(MappedLight(FrameRingLight(frame_ring), PixelMap.mirrored(args.light_count)), ConnectionEventStream(light_event_sender)), layer_command_receiver)),
+            multiprocessing.Process(target = run_output_process,      args = (frame_ring, create_light))]
+
+        for render_process in render_processes:
+            render_process.start()
+
+        if args.light_driver == 'timing' or args.profile:
+            # the trace is kept by the output process; pass requests on to it
+            output_process = render_processes[1]
+            signal.signal(signal.SIGUSR1, lambda signal_number, frame: os.kill(output_process.pid, signal.SIGUSR1))
+
+        light = None
+        output_light = None
+        render_light_controllers = []
+        light_controller = create_light_controller(NullLight((args.light_count + 1) // 2), light_event_stream, layer_command_connection = layer_command_sender)
+
+        light_event_thread = threading.Thread(target = ConnectionEventStream.forward, args = (light_event_receiver, light_event_stream))
+        light_event_thread.daemon = True
+        light_event_thread.start()
+
     server_address = (args.server_address or '', args.server_port)
-    server = BaseHTTPServer.HTTPServer(server_address, ControlHTTPRequestHandler)
 
-    if args.light_driver == 'neopixel': light = NeopixelLight(strip_size = args.light_count, strip_pin = 18)
-    if args.light_driver == 'console':  light = ConsoleLight (strip_size = args.light_count, write_prefix = '\r', write_suffix = '\n')
-    if args.light_driver == 'timing':   light = TimingLight  (strip_size = args.light_count, write_prefix = '\r', write_suffix = '\n')
+    if args.process_mode == 'eventloop':
+        # renders the controllers itself, between requests
+        server = EventLoopHTTPServer(server_address, EventLoopControlHTTPRequestHandler, render_light_controllers)
+    else:
+        if args.server_mode == 'single': server = ControlHTTPServer(server_address, ControlHTTPRequestHandler)
+        if args.server_mode == 'pooled': server = PooledHTTPServer(server_address, PersistentControlHTTPRequestHandler, worker_count = args.server_workers or 4)
+
+    server.request_timeout = args.request_timeout
+    server.keep_alive_timeout = args.keep_alive_timeout
+
+    server.web_asset_cache = WebAssetCache(
+        os.path.join(os.path.dirname(os.path.realpath(__file__)), 'web'),
+        max_age     = args.web_max_age,
+        check_mtime = args.web_check_mtime)
+
+    if args.web_preload:
+        server.web_asset_cache.preload()
+
+    if light_zones:
+        light_manager = light_zones.values()[0][1]
+    else:
+        light_manager = create_light_manager(light_controller)
+
+    server.light_controller   = light_controller
+    server.light_manager      = light_manager
+    server.light_zones        = light_zones
+    server.light_event_stream = light_event_stream
+    server.metrics            = metrics
 
-    light_controller = LightController(
-        light,
-        step_rate = args.step_rate)
+    # none in processes mode, where the light is created by the output process
+    server.power_limited_light = (power_limited_lights[0] if power_limited_lights else None)
 
-    light_manager = LightManager(
-        light_controller,
-        cycle_light_colors = [
-            (255,80,12),    # warm orange
-            (255,160,64)],  # nice natural white
-        cycle_transition_time = 2.0,
-        off_transition_time   = 2.0)
+    if args.process_mode != 'eventloop':
+        server.light_event_stream.start()
 
-    server.light_controller = light_controller
-    server.light_manager    = light_manager
-    server.light_controller.start()
+        for render_light_controller in render_light_controllers:
+            render_light_controller.start()
 
     def sigint_handler(signal, frame):
         def shutdown_server():
@@ -719,12 +5086,38 @@ if __name__ == '__main__':
         shutdown_server_thread = threading.Thread(target = shutdown_server)
         shutdown_server_thread.start()
 
-    signal.signal(signal.SIGINT, sigint_handler)
+    def sigint_handler_eventloop(signal, frame):
+        print 'Initiating server shutdown...'
+        server.shutdown()
 
+    signal.signal(signal.SIGINT, (sigint_handler_eventloop if args.process_mode == 'eventloop' else sigint_handler))
+
+    print 'Started in %.0f ms, %.0f ms of which importing the %s light driver.' % ((time.time() - startup_start_time) * 1000.0, light_driver.import_duration * 1000.0, light_driver.name)
     print 'Ready to receive HTTP requests on http://%s:%d (press Ctrl+C to exit).' % (server.server_name, server.server_port)
 
     server.serve_forever(poll_interval = 0.5)
-    server.light_controller.stop()
+    server.server_close()
+
+    for render_light_controller in render_light_controllers:
+        render_light_controller.stop()
+
+    if args.process_mode == 'processes':
+        layer_command_sender.send(None)
+
+        for render_process in render_processes:
+            render_process.join()
+
+    server.light_event_stream.stop()
+
+    if output_light:
+        output_light.close()
+
+    if isinstance(light, TimingLight):
+        light.stop()
+
+    if args.process_mode != 'processes':
+        print 'Showed %d frames, skipped %d unchanged frames, dropped %d late frames.' % (light_controller.frames_shown, light_controller.frames_skipped, light_controller.frames_missed)
+        print 'Step rate: target %d/s, last achieved %.1f/s.' % (light_controller.step_rate, light_controller.step_rate_achieved)
 
     print 'Exiting.'
 
@@ -0,0 +1,541 @@
+import argparse
+import array
+import httplib
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import ambientlight
+
+
+# compositing:  frames composited back to back on a virtual clock, per strip size, layer depth and step rate
+# console:      ConsoleLight.show encoding throughput into a discarding stream, 256 colors and truecolor
+# network:      DDPLight and E131Light show until the frame arrives at a UDPPixelReceiver on loopback
+# replay:       frames of a RecordingLight capture (--capture) shown back to back on the null and console drivers
+# correction:   high precision frames through gamma and white balance tables, with and without dithering
+# http:         PUT /light through ControlHTTPRequestHandler until the first frame reaches the light
+# startup:      import ambientlight, then the modules of each light driver, in a fresh process per run
+
+
+def percentile(sorted_values, fraction):
+
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize_durations(durations):
+
+    sorted_durations = sorted(durations)
+    total_duration = sum(sorted_durations)
+
+    return {
+        'count':   len(sorted_durations),
+        'rate':    (len(sorted_durations) / total_duration if total_duration > 0.0 else 0.0),
+        'mean_ms': total_duration / max(1, len(sorted_durations)) * 1000.0,
+        'p50_ms':  percentile(sorted_durations, 0.50) * 1000.0,
+        'p95_ms':  percentile(sorted_durations, 0.95) * 1000.0,
+        'p99_ms':  percentile(sorted_durations, 0.99) * 1000.0,
+        'max_ms':  sorted_durations[-1] * 1000.0 if sorted_durations else 0.0,
+    }
+
+
+
+class DiscardStream(object):
+
+    def __init__(self):
+
+        self.write_count = 0
+        self.write_length = 0
+
+
+    def write(self, data):
+
+        self.write_count += 1
+        self.write_length += len(data)
+
+
+    def flush(self):
+
+        pass
+
+
+
+class SignalingLight(ambientlight.NullLight):
+
+    # lets the HTTP benchmark wait for the first frame after a request
+
+    def __init__(self, strip_size):
+
+        ambientlight.NullLight.__init__(self, strip_size)
+
+        self.show_event = threading.Event()
+
+
+    def show(self):
+
+        ambientlight.NullLight.show(self)
+
+        self.show_event.set()
+
+
+
+class QuietControlHTTPRequestHandler(ambientlight.ControlHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+
+class QuietEventLoopControlHTTPRequestHandler(ambientlight.EventLoopControlHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+
+        pass
+
+
+
+def benchmark_compositing(strip_size, layer_count, step_rate, frame_count, compositor_name, layer_sampling):
+
+    clock = ambientlight.VirtualClock()
+
+    light_controller = ambientlight.LightController(
+        ambientlight.MappedLight(ambientlight.NullLight(strip_size), ambientlight.PixelMap.mirrored(strip_size)),
+        step_rate  = step_rate,
+        compositor = ambientlight.create_compositor(compositor_name, table_sampling = (layer_sampling == 'table')),
+        clock      = clock)
+
+    step_duration = 1.0 / step_rate
+
+    # long enough that no layer completes while measuring, with the layers
+    # staggered over the first half so that they overlap partially
+    transition_time = 3.0 * frame_count * step_duration
+    stagger_duration = transition_time / (2.0 * layer_count)
+
+    layer_colors = [(255,80,12), (0,0,40), (255,160,64), (20,0,0)]
+
+    for layer_index in xrange(layer_count):
+        light_controller.set_light_color(layer_colors[layer_index % len(layer_colors)], transition_time)
+        light_controller.render_steps(stagger_duration, 1)
+
+    frame_durations = []
+
+    for frame_index in xrange(frame_count):
+        frame_start_time = time.time()
+        light_controller.render_steps(step_duration, 1)
+        frame_durations += [time.time() - frame_start_time]
+
+    result = summarize_durations(frame_durations)
+    result['layers'] = len(light_controller.layers)
+
+    return result
+
+
+def benchmark_correction(strip_size, frame_count, compositor_name, dithering = False):
+
+    color_correction = ambientlight.create_color_correction(compositor_name, strip_size, gamma = 2.2, white_balance = (1.0, 0.63, 0.25), dithering = dithering)
+
+    # dim fade, where dithering has the most fractions to carry
+    frames = [
+        bytearray(array.array('H', [frame_index * 64 + channel_index % 256 for channel_index in xrange(strip_size * 3)]).tostring())
+            for frame_index
+            in xrange(16)]
+
+    correct_durations = []
+
+    for frame_index in xrange(frame_count):
+        correct_start_time = time.time()
+        color_correction.correct_frame(frames[frame_index % len(frames)])
+        correct_durations += [time.time() - correct_start_time]
+
+    return summarize_durations(correct_durations)
+
+
+def benchmark_console(strip_size, frame_count, truecolor = False):
+
+    write_stream = DiscardStream()
+    light = ambientlight.ConsoleLight(strip_size, write_stream = write_stream, write_prefix = '\r', write_suffix = '\n', truecolor = truecolor)
+
+    # gradient, so that the encoding has to cover all kinds of pixels
+    frames = []
+    for frame_index in xrange(16):
+        frame = bytearray(strip_size * 3)
+        for pixel_index in xrange(strip_size):
+            frame[pixel_index*3:pixel_index*3+3] = (
+                (pixel_index * 7 + frame_index * 16) % 256,
+                (pixel_index * 3 + frame_index * 8) % 256,
+                (pixel_index * 5) % 256)
+        frames += [frame]
+
+    show_durations = []
+
+    for frame_index in xrange(frame_count):
+        light.set_frame(frames[frame_index % len(frames)])
+
+        show_start_time = time.time()
+        light.show()
+        show_durations += [time.time() - show_start_time]
+
+    result = summarize_durations(show_durations)
+    result['pixel_rate'] = result['rate'] * strip_size
+    result['bytes_per_frame'] = write_stream.write_length / float(frame_count)
+
+    return result
+
+
+def benchmark_network(strip_size, frame_count, protocol):
+
+    received_light = ambientlight.NullLight(strip_size)
+    receiver = ambientlight.UDPPixelReceiver(received_light, protocol, ('127.0.0.1', 0))
+
+    receiver_address = receiver.socket.getsockname()
+
+    if protocol == 'ddp':  light = ambientlight.DDPLight (strip_size, host = receiver_address[0], port = receiver_address[1])
+    if protocol == 'e131': light = ambientlight.E131Light(strip_size, host = receiver_address[0], port = receiver_address[1])
+
+    show_durations = []
+
+    for frame_index in xrange(frame_count):
+        frame = bytearray([frame_index % 256]) * (strip_size * 3)
+
+        show_start_time = time.time()
+        light.set_frame(frame)
+        light.show()
+
+        # all packets of the frame, however the receiver gets to read them
+        while received_light.strip_frame != frame:
+            if not receiver.receive(1.0):
+                break
+
+        show_durations += [time.time() - show_start_time]
+
+    result = summarize_durations(show_durations)
+    result['packets_per_frame'] = len(light.packets)
+
+    return result
+
+
+def benchmark_replay(frame_capture, light_driver):
+
+    if light_driver == 'null':    light = ambientlight.NullLight(frame_capture.strip_size)
+    if light_driver == 'console': light = ambientlight.ConsoleLight(frame_capture.strip_size, write_stream = DiscardStream(), write_prefix = '\r', write_suffix = '\n')
+
+    show_durations = []
+
+    for show_time, frame in frame_capture.frames():
+        show_start_time = time.time()
+        light.set_frame(frame)
+        light.show()
+        show_durations += [time.time() - show_start_time]
+
+    return summarize_durations(show_durations)
+
+
+def benchmark_http(strip_size, request_count, step_rate, compositor_name, process_mode = 'threads'):
+
+    light = SignalingLight(strip_size)
+
+    light_controller = ambientlight.LightController(
+        ambientlight.MappedLight(light, ambientlight.PixelMap.mirrored(strip_size)),
+        step_rate  = step_rate,
+        compositor = ambientlight.create_compositor(compositor_name))
+
+    if process_mode == 'threads':   server = ambientlight.ControlHTTPServer(('127.0.0.1', 0), QuietControlHTTPRequestHandler)
+    if process_mode == 'eventloop': server = ambientlight.EventLoopHTTPServer(('127.0.0.1', 0), QuietEventLoopControlHTTPRequestHandler, [light_controller])
+    server.request_timeout    = 10.0
+    server.web_asset_cache    = None
+    server.light_controller   = light_controller
+    server.light_manager      = ambientlight.LightManager(light_controller, cycle_light_colors = [(255,80,12), (255,160,64)])
+    server.light_zones        = {}
+    server.light_event_stream = None
+    server.metrics            = None
+    server.power_limited_light = None
+
+    server_thread = threading.Thread(target = server.serve_forever, kwargs = {'poll_interval': 0.05})
+    server_thread.start()
+
+    if process_mode == 'threads':
+        light_controller.start()
+
+    request_durations = []
+    frame_durations = []
+
+    try:
+        for request_index in xrange(request_count):
+            # wait for the previous change to settle, so the next shown frame is ours
+            while light_controller.layers:
+                time.sleep(0.001)
+            light.show_event.clear()
+
+            request_body = 'r=%d&g=%d&b=%d' % ((255,80,12) if request_index % 2 else (0,0,40))
+
+            request_start_time = time.time()
+
+            connection = httplib.HTTPConnection('127.0.0.1', server.server_port)
+            connection.request('PUT', '/light', request_body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            connection.getresponse().read()
+            connection.close()
+
+            request_durations += [time.time() - request_start_time]
+
+            light.show_event.wait(5.0)
+            frame_durations += [time.time() - request_start_time]
+
+    finally:
+        server.shutdown()
+        server_thread.join()
+        server.server_close()
+        light_controller.stop()
+
+    return {
+        'request':     summarize_durations(request_durations),
+        'first_frame': summarize_durations(frame_durations),
+    }
+
+
+startup_script = '''
+import json, sys, time
+start_time = time.time()
+import ambientlight
+import_duration = time.time() - start_time
+light_driver = ambientlight.find_light_driver(sys.argv[1]) if len(sys.argv) > 1 else None
+try:
+    driver_duration = light_driver.import_modules() if light_driver else 0.0
+except ImportError:
+    driver_duration = None
+print json.dumps([import_duration, driver_duration])
+'''
+
+
+def benchmark_startup(run_count, light_driver_name = None):
+
+    # a fresh interpreter each run, so no module is already loaded
+    startup_durations = []
+
+    for run_index in xrange(run_count):
+        startup_output = subprocess.check_output([sys.executable, '-c', startup_script] + ([light_driver_name] if light_driver_name else []),
+            cwd = os.path.dirname(os.path.abspath(__file__)))
+
+        import_duration, driver_duration = json.loads(startup_output.splitlines()[-1])
+
+        if driver_duration is None:
+            return None
+
+        startup_durations += [import_duration + driver_duration]
+
+    return summarize_durations(startup_durations)
+
+
+def run_benchmarks(args):
+
+    results = {}
+
+    if 'compositing' in args.suites:
+        for strip_size in args.strip_sizes:
+            for layer_count in args.layer_counts:
+                for step_rate in args.step_rates:
+                    result_name = 'compositing/%dpx/%dlayers/%dhz' % (strip_size, layer_count, step_rate)
+                    results[result_name] = benchmark_compositing(strip_size, layer_count, step_rate, args.frames, args.compositor, args.layer_sampling)
+                    print_result(result_name, results[result_name])
+
+    if 'console' in args.suites:
+        for strip_size in args.strip_sizes:
+            result_name = 'console/%dpx' % strip_size
+            results[result_name] = benchmark_console(strip_size, args.frames)
+            print_result(result_name, results[result_name])
+
+            result_name = 'console/%dpx/truecolor' % strip_size
+            results[result_name] = benchmark_console(strip_size, args.frames, truecolor = True)
+            print_result(result_name, results[result_name])
+
+    if 'network' in args.suites:
+        for strip_size in args.strip_sizes:
+            for protocol in ('ddp', 'e131'):
+                result_name = 'network/%s/%dpx' % (protocol, strip_size)
+                results[result_name] = benchmark_network(strip_size, args.frames, protocol)
+                print_result(result_name, results[result_name])
+
+    if 'correction' in args.suites:
+        for strip_size in args.strip_sizes:
+            result_name = 'correction/%dpx' % strip_size
+            results[result_name] = benchmark_correction(strip_size, args.frames, args.compositor)
+            print_result(result_name, results[result_name])
+
+            result_name = 'correction/%dpx/dithering' % strip_size
+            results[result_name] = benchmark_correction(strip_size, args.frames, args.compositor, dithering = True)
+            print_result(result_name, results[result_name])
+
+    if 'replay' in args.suites and args.capture:
+        frame_capture = ambientlight.FrameCapture(args.capture)
+
+        for light_driver in ('null', 'console'):
+            result_name = 'replay/%s/%dpx' % (light_driver, frame_capture.strip_size)
+            results[result_name] = benchmark_replay(frame_capture, light_driver)
+            print_result(result_name, results[result_name])
+
+        frame_capture.close()
+
+    if 'http' in args.suites:
+        for process_mode in ['threads', 'eventloop']:
+            result = benchmark_http(57, args.requests, 60, args.compositor, process_mode)
+            for result_part, part_result in sorted(result.items()):
+                result_name = ('http/put_light/%s' if process_mode == 'threads' else 'http/eventloop/put_light/%s') % result_part
+                results[result_name] = part_result
+                print_result(result_name, results[result_name])
+
+    if 'startup' in args.suites:
+        result_name = 'startup/import'
+        results[result_name] = benchmark_startup(args.startup_runs)
+        print_result(result_name, results[result_name])
+
+        for light_driver_name in ambientlight.light_drivers:
+            result = benchmark_startup(args.startup_runs, light_driver_name)
+            if result is None:
+                print '%-36s unavailable' % ('startup/driver/%s' % light_driver_name)
+                continue
+            result_name = 'startup/driver/%s' % light_driver_name
+            results[result_name] = result
+            print_result(result_name, results[result_name])
+
+    return results
+
+
+def check_startup_budget(results, startup_budget_ms):
+
+    # startup with a driver must fit the budget however the machine compares to the baseline
+    over_budget_names = []
+
+    for result_name in sorted(results):
+        if not result_name.startswith('startup/'):
+            continue
+
+        over_budget = (results[result_name]['p50_ms'] > startup_budget_ms)
+
+        if over_budget:
+            over_budget_names += [result_name]
+
+        print '%-36s %8.3f ms of %8.3f ms%s' % (result_name, results[result_name]['p50_ms'], startup_budget_ms, '  OVER BUDGET' if over_budget else '')
+
+    return over_budget_names
+
+
+def print_result(result_name, result):
+
+    print '%-36s %9.1f/s  p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms  max %8.3f ms' % (
+        result_name, result['rate'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms'])
+
+
+def compare_results(results, baseline_results, tolerance):
+
+    # median latency is the most stable figure; a rise beyond tolerance is a regression
+    regression_names = []
+
+    for result_name in sorted(results):
+        if result_name not in baseline_results:
+            continue
+
+        p50_ms = results[result_name]['p50_ms']
+        baseline_p50_ms = baseline_results[result_name]['p50_ms']
+
+        if baseline_p50_ms <= 0.0:
+            continue
+
+        change = p50_ms / baseline_p50_ms - 1.0
+        regressed = (change > tolerance)
+
+        if regressed:
+            regression_names += [result_name]
+
+        print '%-36s %8.3f ms -> %8.3f ms  %+6.1f%%%s' % (result_name, baseline_p50_ms, p50_ms, change * 100.0, '  REGRESSION' if regressed else '')
+
+    return regression_names
+
+
+if __name__ == '__main__':
+
+    def argparse_int_list(arg):
+        return [int(value) for value in arg.split(',')]
+
+    def argparse_suite_list(arg):
+        suites = arg.split(',')
+        for suite in suites:
+            if suite not in ('compositing', 'console', 'network', 'correction', 'replay', 'http', 'startup'):
+                raise argparse.ArgumentTypeError('unknown suite: %s' % suite)
+        return suites
+
+    argparser = argparse.ArgumentParser(description = 'Ambient light benchmarks.')
+
+    argparser.add_argument('--suites',         type = argparse_suite_list,              default = ['compositing', 'console', 'network', 'correction', 'replay', 'http', 'startup'])
+    argparser.add_argument('--strip-sizes',    type = argparse_int_list,                default = [16, 57, 300, 1000])
+    argparser.add_argument('--layer-counts',   type = argparse_int_list,                default = [1, 4, 16])
+    argparser.add_argument('--step-rates',     type = argparse_int_list,                default = [30, 60, 120])
+    argparser.add_argument('--frames',         type = int,                              default = 200)
+    argparser.add_argument('--requests',       type = int,                              default = 50)
+    argparser.add_argument('--startup-runs',   type = int,                              default = 10)
+    argparser.add_argument('--startup-budget', type = float,                            default = 100.0)
+    argparser.add_argument('--compositor',     choices = ['auto', 'numpy', 'python'],   default = 'auto')
+    argparser.add_argument('--layer-sampling', choices = ['interpolate', 'table'],      default = 'interpolate')
+    argparser.add_argument('--capture',        type = str,                              default = None)
+    argparser.add_argument('--output',         type = str,                              default = None)
+    argparser.add_argument('--baseline',       type = str,                              default = None)
+    argparser.add_argument('--save-baseline',  action = 'store_true')
+    argparser.add_argument('--tolerance',      type = float,                            default = 0.2)
+
+    args = argparser.parse_args()
+
+    # none is committed, as results only compare on the machine that saved them
+    if args.baseline and not args.save_baseline and not os.path.exists(args.baseline):
+        argparser.error('--baseline: no baseline at %s; run with --save-baseline to store one' % args.baseline)
+
+    results = run_benchmarks(args)
+
+    report = {
+        'python':     platform.python_version(),
+        'machine':    platform.machine(),
+        'compositor': ambientlight.create_compositor(args.compositor).__class__.__name__,
+        'results':    results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent = 2, sort_keys = True)
+
+    # failures only decide the exit status, so that a baseline is still saved
+    exit_status = 0
+
+    if 'startup' in args.suites:
+        print
+        over_budget_names = check_startup_budget(results, args.startup_budget)
+
+        if over_budget_names:
+            print '%d startup(s) over the %.0f ms budget.' % (len(over_budget_names), args.startup_budget)
+            exit_status = 1
+
+    if args.baseline:
+        if args.save_baseline:
+            with open(args.baseline, 'w') as baseline_file:
+                json.dump(report, baseline_file, indent = 2, sort_keys = True)
+            print 'Saved baseline to %s.' % args.baseline
+
+        else:
+            with open(args.baseline) as baseline_file:
+                baseline_report = json.load(baseline_file)
+
+            print
+            regression_names = compare_results(results, baseline_report['results'], args.tolerance)
+
+            if regression_names:
+                print '%d regression(s) beyond %.0f%%.' % (len(regression_names), args.tolerance * 100.0)
+                exit_status = 1
+
+    sys.exit(exit_status)
+
+
+# vim:set ts=4 sw=4 et:
@@ -0,0 +1,41 @@
+import argparse
+
+import ambientlight
+
+
+# stands in for a networked pixel controller: shows DDP or E1.31 frames sent by
+# ambientlight.py --light-driver ddp/e131 on the console
+
+
+if __name__ == '__main__':
+
+    argparser = argparse.ArgumentParser(description = 'Ambient light network pixel receiver.')
+
+    argparser.add_argument('--protocol',       choices = ['ddp', 'e131'],   default = 'ddp')
+    argparser.add_argument('--light-count',    type = int,                  default = 16)
+    argparser.add_argument('--address',        type = str,                  default = '')
+    argparser.add_argument('--port',           type = int,                  default = None)
+    argparser.add_argument('--universe',       type = int,                  default = 1)
+    argparser.add_argument('--multicast',      action = 'store_true')
+    argparser.add_argument('--truecolor',      action = 'store_true')
+
+    args = argparser.parse_args()
+
+    light = ambientlight.ConsoleLight(strip_size = args.light_count, write_prefix = '\r', truecolor = args.truecolor)
+
+    receiver = ambientlight.UDPPixelReceiver(light, args.protocol, (args.address, args.port), universe_start = args.universe)
+
+    if args.multicast:
+        receiver.join_multicast_groups()
+
+    try:
+        while True:
+            receiver.receive()
+    except KeyboardInterrupt:
+        pass
+
+    print
+    print 'Received %d packets, showed %d frames.' % (receiver.packet_count, receiver.show_count)
+
+
+# vim:set ts=4 sw=4 et: